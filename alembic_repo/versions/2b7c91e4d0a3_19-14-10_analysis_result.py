@@ -0,0 +1,36 @@
+"""analysis result
+
+Revision ID: 2b7c91e4d0a3
+Revises: 4d3ba0ea64f1
+Create Date: 2026-10-19 14:10:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7c91e4d0a3'
+down_revision = '4d3ba0ea64f1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('analysis_result',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('accessCode', sa.String(length=64), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('added', sa.DateTime(), nullable=True),
+                    sa.Column('method', sa.String(length=16), nullable=True),
+                    sa.Column('data', sa.Text(), nullable=True),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_analysis_result_accessCode', 'analysis_result', ['accessCode'], unique=True)
+    op.create_index('ix_analysis_result_added', 'analysis_result', ['added'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_analysis_result_added', table_name='analysis_result')
+    op.drop_index('ix_analysis_result_accessCode', table_name='analysis_result')
+    op.drop_table('analysis_result')
@@ -0,0 +1,27 @@
+"""existing schema
+
+Revision ID: 4d3ba0ea64f1
+Revises: None
+Create Date: 2026-10-19 14:00:00
+
+The user, fasta_entry, fasta_list and list_to_fasta tables as deployed,
+app.db is stamped with this revision
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d3ba0ea64f1'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
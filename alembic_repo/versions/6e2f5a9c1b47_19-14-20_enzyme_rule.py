@@ -0,0 +1,33 @@
+"""enzyme rule
+
+Revision ID: 6e2f5a9c1b47
+Revises: 2b7c91e4d0a3
+Create Date: 2026-10-19 14:20:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e2f5a9c1b47'
+down_revision = '2b7c91e4d0a3'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('enzyme_rule',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=64), nullable=True),
+                    sa.Column('specificity', sa.String(length=256), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('added', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_enzyme_rule_user_id', 'enzyme_rule', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_enzyme_rule_user_id', table_name='enzyme_rule')
+    op.drop_table('enzyme_rule')
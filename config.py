@@ -1,4 +1,4 @@
-from os import path
+from os import path, environ
 
 basedir = path.abspath(path.dirname(__file__))
 
@@ -12,5 +12,23 @@ OPENID_PROVIDERS = [{'name':'Google', 'url':'https://www.google.com/accounts/o8/
                     {'name':'MyOpenID', 'url':'https://www.myopenid.com'}
                    ]
                    
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path.join(basedir, 'app.db')
+#FPASTE_DATABASE_URI and FPASTE_LIBRARY_CACHE_DIR point a run elsewhere, eg. loadtest.py
+SQLALCHEMY_DATABASE_URI = environ.get("FPASTE_DATABASE_URI", 'sqlite:///' + path.join(basedir, 'app.db'))
 SQLALCHEMY_MIGRATE_REPO = path.join(basedir, 'db_repository')
+
+LIBRARY_CACHE_DIR = environ.get("FPASTE_LIBRARY_CACHE_DIR", path.join(basedir, 'library_cache'))
+
+#resampling runs inside the request: cost grows with iterations x peptides
+#(p-values resolve to 1/ITERATIONS). It stays in the worker process by
+#default, a pool per request would fork every web worker across all cores
+RESAMPLING_ITERATIONS = 1000
+RESAMPLING_PROCESSES = 1
+
+#seconds a stored enzyme analysis can be paged and downloaded
+RESULT_TTL = 7*24*3600
+
+#fasta list access codes whose libraries wsgi.py caches before workers fork
+WARMUP_FASTA_LISTS = []
+
+#seconds a logged in user is served from memory before it is reloaded
+USER_CACHE_TTL = 300
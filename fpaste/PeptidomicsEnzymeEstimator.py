@@ -3,8 +3,14 @@ This work is licensed under a Creative Commons Attribution 3.0 Unported License.
 http://creativecommons.org/licenses/by/3.0/
 """
 
-from Bio import SeqIO
+from collections import OrderedDict, Mapping
 from copy import copy
+from hashlib import sha256
+from multiprocessing import Pool, cpu_count
+from os import path, makedirs, rename, remove, getpid
+from StringIO import StringIO
+import cPickle
+import mmap
 import re
 
 
@@ -24,8 +30,466 @@ _el = { "Arg-C proteinase":                r'([A-Z_]R[A-Z][A-Z_])',
         "Thrombin-OSP":                    r'(LRSK)',
         "_No enzyme":                      r'(__\+__)'}
         
-EnzymeList = {enz: re.compile(_el[enz]) for enz in _el}
-enzymeListNC = {enz: {"n":re.compile(r'\A'+_el[enz]), "c":re.compile(_el[enz]+r'\Z')} for enz in _el}
+aaList = [ "A","G","P","V","L","I","M","C","F","Y","W","H","K","R","Q","N","E","D","S","T" ]
+
+#filled in place by compile_enzyme_tables() on first use
+EnzymeList = {}
+enzymeListNC = {}
+
+def compile_enzyme_tables():
+    """
+    Compiles the enzyme regex tables the first time they are needed and
+    returns enzymeListNC
+    """
+    if not enzymeListNC:
+        EnzymeList.update({enz: re.compile(_el[enz]) for enz in _el})
+        enzymeListNC.update({enz: {"n":re.compile(r'\A'+_el[enz]), "c":re.compile(_el[enz]+r'\Z')} for enz in _el})
+    return enzymeListNC
+
+
+_ruleResidues = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_rulePatternCache = {}
+
+def parse_enzyme_rule(specificity):
+    """
+    Parses a user P2-P2' specificity into a list of alternatives, each a list
+    of four sets of accepted characters ("_" is a chain terminus). Raises
+    ValueError with a readable message for invalid rules
+
+    Syntax: four positions with "|" marking the cleavage between P1 and P1',
+    alternatives separated by ";", whitespace is ignored
+        K      that residue             X   any residue
+        _      a chain terminus         .   any residue or a terminus
+        [KR]   any listed residue       [^P] any residue but those listed
+    e.g. Trypsin is ".[KR]|[^P]." and Thrombin is ".R|G.; GR|X."
+    """
+    alternatives = []
+    for alternativeSpec in specificity.upper().split(";"):
+        alternativeSpec = "".join(alternativeSpec.split())
+        if alternativeSpec.count("|") != 1:
+            raise ValueError("'{}' needs exactly one '|' cleavage site".format(alternativeSpec))
+        positions, cleavageAfter, i = [], None, 0
+        while i < len(alternativeSpec):
+            char = alternativeSpec[i]
+            if char == "|":
+                cleavageAfter = len(positions)
+            elif char == "[":
+                close = alternativeSpec.find("]", i)
+                if close == -1:
+                    raise ValueError("unclosed '[' in '{}'".format(alternativeSpec))
+                members = alternativeSpec[i+1:close]
+                negated = members.startswith("^")
+                if negated:
+                    members = members[1:]
+                if len(members) == 0 or any(member not in _ruleResidues for member in members):
+                    raise ValueError("'[{}]' must list residue letters".format(alternativeSpec[i+1:close]))
+                if negated:
+                    positions.append(set(_ruleResidues) - set(members))
+                else:
+                    positions.append(set(members))
+                i = close
+            elif char == "X":
+                positions.append(set(_ruleResidues))
+            elif char == ".":
+                positions.append(set(_ruleResidues + "_"))
+            elif char in _ruleResidues or char == "_":
+                positions.append(set(char))
+            else:
+                raise ValueError("unexpected '{}' in '{}'".format(char, alternativeSpec))
+            i += 1
+        if len(positions) != 4 or cleavageAfter != 2:
+            raise ValueError("'{}' must give two positions on each side of '|'".format(alternativeSpec))
+        alternatives.append(positions)
+    return alternatives
+
+
+def enzyme_rule_pattern(specificity):
+    """
+    Compiles a user specificity (see parse_enzyme_rule) into the four residue
+    pattern form of the built-in enzymes, cached per specificity
+    """
+    if specificity not in _rulePatternCache:
+        alternatives = ["".join("[" + "".join(sorted(residues)) + "]" for residues in alternative)
+                        for alternative in parse_enzyme_rule(specificity)]
+        _rulePatternCache[specificity] = "(" + "|".join(alternatives) + ")"
+    return _rulePatternCache[specificity]
+
+
+def custom_enzyme_name(name, specificity):
+    #the specificity is part of the name so rules sharing a name never share a site index
+    return "{} [{}]".format(name, specificity)
+
+
+def select_enzymes(validEnzymeList, customRules={}):
+    """
+    Returns the n and c side regex tables of the selected enzymes, every
+    built-in enzyme when neither enzymes nor rules are selected. customRules
+    = {"enzymeName": "specificity", ...} adds user enzymes, see
+    custom_enzyme_name
+    """
+    compile_enzyme_tables()
+    if len(validEnzymeList) > 0 or len(customRules) > 0:
+        enzymeDict = {enzyme:enzymeListNC[enzyme] for enzyme in validEnzymeList if enzyme in enzymeListNC}
+    else:
+        enzymeDict = dict(enzymeListNC)
+    for enzyme in customRules:
+        pattern = enzyme_rule_pattern(customRules[enzyme])
+        enzymeDict[enzyme] = {"n":re.compile(r'\A'+pattern), "c":re.compile(pattern+r'\Z')}
+    return enzymeDict
+
+
+def warmup():
+    """
+    Loads the heavy dependencies and compiles the enzyme tables. Call it in a
+    preforking server's master process so the workers share them copy-on-write
+    """
+    import Bio.SeqIO
+    import numpy
+    compile_enzyme_tables()
+
+
+class ProteinLibrary(object):
+    """
+    This class represents a protein library together with an index of the
+    positions every enzyme is able to cleave
+
+    Attributes:
+    .proteinDict = {"accession":"SEQUENCE", ...}
+    .siteIndex = {"accession": {"enzymeName": bytearray, ...}, ...}
+        bit p of the bytearray is set when the enzyme cleaves between residue
+        p-1 and p, so a peptide spanning [start, end) is tested at start and end
+    .siteCounts = {"accession": {"enzymeName": int, ...}, ...}
+
+    Methods:
+    .__init__(proteinDict, enzymeRegexStrDict=None)
+        enzymeRegexStrDict defaults to every enzyme in enzymeListNC
+
+    .index_enzymes(enzymeRegexStrDict)
+        enzymeRegexStrDict = {"enzymeName":r'(XYZW)', ...}, four character
+                                patterns with cleavage between Y and Z
+
+    .has_site(accession, enzyme, position)
+
+    .site_count(accession, enzyme)
+
+    .from_fasta(fastaFileObject, enzymeRegexStrDict=None) (classmethod)
+    """
+
+    def __init__(self, proteinDict, enzymeRegexStrDict=None):
+        if enzymeRegexStrDict is None:
+            enzymeRegexStrDict = _el
+        self.proteinDict = proteinDict
+        self.siteIndex = {accession: {} for accession in proteinDict}
+        self.siteCounts = {accession: {} for accession in proteinDict}
+        self.index_enzymes(enzymeRegexStrDict)
+
+    @classmethod
+    def from_fasta(cls, fastaFileObject, enzymeRegexStrDict=None):
+        from Bio import SeqIO
+        proteinDict = {p.id:str(p.seq) for p in SeqIO.parse(fastaFileObject, "fasta")}
+        return cls(proteinDict, enzymeRegexStrDict)
+
+    def index_enzymes(self, enzymeRegexStrDict):
+        siteReDict = _site_regexes(enzymeRegexStrDict)
+        for accession in self.proteinDict:
+            for enzyme in siteReDict:
+                bitmap, count = _site_bitmap(self.proteinDict[accession], siteReDict[enzyme])
+                self.siteIndex.setdefault(accession, {})[enzyme] = bitmap
+                self.siteCounts.setdefault(accession, {})[enzyme] = count
+
+    def has_site(self, accession, enzyme, position):
+        bitmap = self.siteIndex[accession][enzyme]
+        return bool(bitmap[position >> 3] & (1 << (position & 7)))
+
+    def site_count(self, accession, enzyme):
+        return self.siteCounts[accession][enzyme]
+
+    def __repr__(self):
+        return "<ProteinLibrary: proteins={}>".format(len(self.proteinDict))
+
+
+class RuleIndexedLibrary(ProteinLibrary):
+    """
+    A ProteinLibrary extended by user enzymes for one analysis. The sites of
+    the rules are indexed per protein on first use, so only the proteins the
+    analysis observes are searched and the shared library is never changed
+
+    .__init__(library, customRules)
+        customRules = {"enzymeName": "specificity", ...}, see custom_enzyme_name
+    """
+
+    def __init__(self, library, customRules):
+        self.library = library
+        self.proteinDict = library.proteinDict
+        self.customRules = dict(customRules)
+        self.siteIndex = {}
+        self.siteCounts = {}
+        self._siteReDict = _site_regexes({enzyme: enzyme_rule_pattern(customRules[enzyme])
+                                          for enzyme in customRules})
+
+    def _index_protein(self, accession):
+        if accession not in self.siteIndex:
+            bitmaps, counts = {}, {}
+            for enzyme in self._siteReDict:
+                bitmaps[enzyme], counts[enzyme] = _site_bitmap(self.proteinDict[accession], self._siteReDict[enzyme])
+            self.siteCounts[accession] = counts
+            self.siteIndex[accession] = bitmaps
+
+    def has_site(self, accession, enzyme, position):
+        if enzyme not in self._siteReDict:
+            return self.library.has_site(accession, enzyme, position)
+        self._index_protein(accession)
+        return ProteinLibrary.has_site(self, accession, enzyme, position)
+
+    def site_count(self, accession, enzyme):
+        if enzyme not in self._siteReDict:
+            return self.library.site_count(accession, enzyme)
+        self._index_protein(accession)
+        return ProteinLibrary.site_count(self, accession, enzyme)
+
+    def __repr__(self):
+        return "<RuleIndexedLibrary: {!r} rules={}>".format(self.library, len(self.customRules))
+
+
+def with_custom_rules(library, customRules):
+    """
+    Returns library extended by the user enzymes customRules, a library that
+    already carries them is returned as it is
+    """
+    if library is None or len(customRules) == 0:
+        return library
+    if isinstance(library, RuleIndexedLibrary) and all(library.customRules.get(enzyme) == customRules[enzyme]
+                                                       for enzyme in customRules):
+        return library
+    return RuleIndexedLibrary(library, customRules)
+
+
+def _site_regexes(enzymeRegexStrDict):
+    #a lookahead finds every (overlapping) four residue window in one pass
+    return {enz: re.compile(r'(?=' + enzymeRegexStrDict[enz] + r')') for enz in enzymeRegexStrDict}
+
+
+def _site_bitmap(sequence, siteRe):
+    paddedSequence = "__" + str(sequence) + "__"
+    bitmap = bytearray(len(paddedSequence) // 8 + 1)
+    count = 0
+    for match in siteRe.finditer(paddedSequence):
+        position = match.start()
+        bitmap[position >> 3] |= 1 << (position & 7)
+        count += 1
+    return bitmap, count
+
+
+class _MappedSequences(Mapping):
+    """
+    Read only {"accession": sequence} view of a memory mapped sequence file,
+    values are buffers into the map so lookups and regex searches never copy
+    """
+
+    def __init__(self, sequenceMap, offsets):
+        self._map = sequenceMap
+        self._offsets = offsets
+
+    def __getitem__(self, accession):
+        offset, length = self._offsets[accession]
+        return buffer(self._map, offset, length)
+
+    def __contains__(self, accession):
+        return accession in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+
+class MappedProteinLibrary(ProteinLibrary):
+    """
+    A ProteinLibrary read from the on-disk format written by
+    write_mapped_library. Sequences and the site index stay in the memory
+    mapped files, so every process opening the same library shares one copy
+    through the page cache
+
+    Files:
+    basePath.seq   = sequences back to back, each followed by a newline
+    basePath.sites = site bitmaps, per protein one bitmap per indexed enzyme
+    basePath.idx   = "#enzymes" and the indexed enzyme names, then one line per
+                     protein: accession, sequence offset, length, site offset
+                     and comma separated site counts (tab separated, like .fai)
+
+    Only the enzymes written to the files are indexed, user enzymes are added
+    per analysis by RuleIndexedLibrary
+    """
+
+    def __init__(self, basePath):
+        self.basePath = basePath
+        with open(basePath + ".seq", "rb") as sequenceFile:
+            self._sequenceMap = mmap.mmap(sequenceFile.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(basePath + ".sites", "rb") as siteFile:
+            self._siteMap = mmap.mmap(siteFile.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets, self._siteOffsets, self._mappedCounts = {}, {}, {}
+        with open(basePath + ".idx", "r") as indexFile:
+            self._mappedEnzymes = {enzyme: i for i, enzyme in
+                                   enumerate(indexFile.readline().rstrip("\n").split("\t")[1:])}
+            for line in indexFile:
+                accession, offset, length, siteOffset, counts = line.rstrip("\n").split("\t")
+                offsets[accession] = (int(offset), int(length))
+                self._siteOffsets[accession] = int(siteOffset)
+                self._mappedCounts[accession] = counts
+        self.proteinDict = _MappedSequences(self._sequenceMap, offsets)
+
+    def index_enzymes(self, enzymeRegexStrDict):
+        raise NotImplementedError("Mapped libraries only hold the enzymes written by write_mapped_library")
+
+    def has_site(self, accession, enzyme, position):
+        length = self.proteinDict._offsets[accession][1]
+        bitmapOffset = self._siteOffsets[accession] + self._mappedEnzymes[enzyme]*((length + 4) // 8 + 1)
+        return bool(ord(self._siteMap[bitmapOffset + (position >> 3)]) & (1 << (position & 7)))
+
+    def site_count(self, accession, enzyme):
+        return int(self._mappedCounts[accession].split(",")[self._mappedEnzymes[enzyme]])
+
+    def __getstate__(self):
+        return {"basePath": self.basePath}
+
+    def __setstate__(self, state):
+        self.__init__(state["basePath"])
+
+    def __repr__(self):
+        return "<MappedProteinLibrary: {} proteins={}>".format(self.basePath, len(self.proteinDict))
+
+
+def write_mapped_library(records, basePath, enzymeRegexStrDict=None):
+    """
+    Writes (accession, sequence) records in the MappedProteinLibrary format,
+    indexing every enzyme in enzymeRegexStrDict (default: all enzymes). The
+    files are written under temporary names and renamed into place, index last
+    """
+    if enzymeRegexStrDict is None:
+        enzymeRegexStrDict = _el
+    enzymes = sorted(enzymeRegexStrDict)
+    siteReDict = _site_regexes(enzymeRegexStrDict)
+    directory = path.dirname(basePath)
+    if directory and not path.isdir(directory):
+        makedirs(directory)
+    tempBase = "{}.{}.tmp".format(basePath, getpid())
+    sequenceOffset, siteOffset = 0, 0
+    with open(tempBase + ".seq", "wb") as sequenceFile, \
+         open(tempBase + ".sites", "wb") as siteFile, \
+         open(tempBase + ".idx", "w") as indexFile:
+        indexFile.write("\t".join(["#enzymes"] + enzymes) + "\n")
+        for accession, sequence in records:
+            if isinstance(sequence, unicode):
+                sequence = sequence.encode("utf-8")
+            counts = []
+            for enzyme in enzymes:
+                bitmap, count = _site_bitmap(sequence, siteReDict[enzyme])
+                siteFile.write(bitmap)
+                counts.append(str(count))
+            sequenceFile.write(sequence + "\n")
+            indexFile.write("\t".join([accession, str(sequenceOffset), str(len(sequence)),
+                                       str(siteOffset), ",".join(counts)]) + "\n")
+            sequenceOffset += len(sequence) + 1
+            siteOffset += len(enzymes)*((len(sequence) + 4) // 8 + 1)
+        #mmap refuses empty files
+        sequenceFile.write("\n")
+        siteFile.write("\0")
+    for extension in (".seq", ".sites", ".idx"):
+        rename(tempBase + extension, basePath + extension)
+
+
+MAPPED_LIBRARY_CACHE_SIZE = 32
+_mappedLibraries = OrderedDict()
+
+def open_mapped_library(basePath, records=None, enzymeRegexStrDict=None, supersededPaths=None):
+    """
+    Returns the MappedProteinLibrary at basePath, opened once per process and
+    kept for the MAPPED_LIBRARY_CACHE_SIZE most recently used libraries.
+    When the files do not exist yet they are written from records, a callable
+    returning (accession, sequence) records
+
+    supersededPaths is a callable returning the base paths of older versions
+    of this library. When basePath is first opened in this process they are
+    dropped from the cache and their files removed
+    """
+    if basePath in _mappedLibraries:
+        library = _mappedLibraries.pop(basePath)
+        _mappedLibraries[basePath] = library
+        return library
+    try:
+        library = MappedProteinLibrary(basePath)
+    except EnvironmentError:
+        #missing, or removed as superseded by a process that saw a newer version
+        if records is None:
+            raise LookupError("No mapped library at '{}'".format(basePath))
+        write_mapped_library(records(), basePath, enzymeRegexStrDict)
+        library = MappedProteinLibrary(basePath)
+    if supersededPaths is not None:
+        for stalePath in supersededPaths():
+            if stalePath != basePath:
+                remove_mapped_library(stalePath)
+    _mappedLibraries[basePath] = library
+    while len(_mappedLibraries) > MAPPED_LIBRARY_CACHE_SIZE:
+        _mappedLibraries.popitem(last=False)
+    return library
+
+
+def remove_mapped_library(basePath):
+    """
+    Drops the library at basePath from this process and deletes its files.
+    Its maps are closed once no running analysis holds it any more, other
+    processes keep reading their maps of the unlinked files
+    """
+    _mappedLibraries.pop(basePath, None)
+    for extension in (".idx", ".seq", ".sites"):
+        try:
+            remove(basePath + extension)
+        except OSError:
+            pass
+
+
+_libraryCache = OrderedDict()
+LIBRARY_CACHE_SIZE = 8
+
+def load_protein_library(fastaText, cacheDir=None):
+    """
+    This function returns an indexed ProteinLibrary for the fasta text. Libraries
+    are cached by content in memory and, when cacheDir is given, pickled to disk
+    so the site index is only built once per library version
+    """
+    if isinstance(fastaText, unicode):
+        fastaText = fastaText.encode("utf-8")
+    digest = sha256(fastaText).hexdigest()
+    if digest in _libraryCache:
+        library = _libraryCache.pop(digest)
+        _libraryCache[digest] = library
+        return library
+
+    library = None
+    if cacheDir is not None:
+        cachePath = path.join(cacheDir, digest + ".pickle")
+        if path.exists(cachePath):
+            try:
+                with open(cachePath, "rb") as cacheFile:
+                    library = cPickle.load(cacheFile)
+            except (EOFError, cPickle.UnpicklingError):
+                library = None
+    if library is None:
+        library = ProteinLibrary.from_fasta(StringIO(fastaText))
+        if cacheDir is not None:
+            if not path.isdir(cacheDir):
+                makedirs(cacheDir)
+            #write then rename so concurrent workers never read a partial file
+            tempPath = "{}.{}.tmp".format(cachePath, getpid())
+            with open(tempPath, "wb") as cacheFile:
+                cPickle.dump(library, cacheFile, cPickle.HIGHEST_PROTOCOL)
+            rename(tempPath, cachePath)
+
+    _libraryCache[digest] = library
+    while len(_libraryCache) > LIBRARY_CACHE_SIZE:
+        _libraryCache.popitem(last=False)
+    return library
 
 
 class Peptide(object):
@@ -55,9 +519,14 @@ class Peptide(object):
         regexDict = {"enzymeName":"XYZW", ...} where XYZW is a four character
                                 pattern with cleavage between Y and Z
         This method will assign .nMatches and .cMatches from the dictionary
+
+    .assign_cleavages_from_index(library, enzymes)
+        library = ProteinLibrary holding this peptide's protein
+        This method will assign .nMatches and .cMatches with a bit test at
+        .start and .end instead of a regex search
     """
     
-    def __init__(self, sequence="", intensity=1, rt=0, sampleId=None, accession=None, proteinDict={}, enzymeRegexDictNC={}):
+    def __init__(self, sequence="", intensity=1, rt=0, sampleId=None, accession=None, proteinDict={}, enzymeRegexDictNC={}, library=None):
         self.sequence = sequence
         self.intensity = intensity
         self.rt = rt
@@ -67,12 +536,17 @@ class Peptide(object):
         self.contextSequence = None
         self.start = None
         self.end = None
+        if library is not None:
+            proteinDict = library.proteinDict
         self.assign_protein(proteinDict)
         
         self.nMatches = []
         self.cMatches = []
         if self.contextSequence is not None:
-            self.assign_cleavages(enzymeRegexDictNC)
+            if library is not None:
+                self.assign_cleavages_from_index(library, enzymeRegexDictNC)
+            else:
+                self.assign_cleavages(enzymeRegexDictNC)
             
     def assign_protein(self, proteinDict):           
         peptideRe = re.compile(self.sequence) 
@@ -95,7 +569,7 @@ class Peptide(object):
                 tempStart = max(0, location.start()-2)
                 tempEnd = min(len(sequence), location.end()+2)
                 startPadding = tempStart - (location.start() - 2)
-                endPadding = tempEnd - (location.end() + 2)
+                endPadding = (location.end() + 2) - tempEnd
                 self.contextSequence = startPadding*"_" + sequence[tempStart:tempEnd] + endPadding*"_"
                 self.accession = proteinKey
                 return True
@@ -115,6 +589,16 @@ class Peptide(object):
                 self.cMatches.append(enzyme)
             if nSideRe.search(contextSequence) is not None:
                 self.nMatches.append(enzyme)
+
+    def assign_cleavages_from_index(self, library, enzymes):
+        #fail immediately if the peptide was not mapped
+        if self.contextSequence is None:
+            return False
+        for enzyme in enzymes:
+            if library.has_site(self.accession, enzyme, self.end):
+                self.cMatches.append(enzyme)
+            if library.has_site(self.accession, enzyme, self.start):
+                self.nMatches.append(enzyme)
         
     def __repr__(self):
         return "<Peptide: accession={}, sampleId={} range=({},{}) >".format(self.accession, self.sampleId, self.start, self.end)
@@ -122,18 +606,36 @@ class Peptide(object):
         
  
  
-def import_peptides_and_preprocess(peptideCsvFileObject, fastaFileObject, validEnzymeList=[]):
+MAPPING_CACHE_SIZE = 200000
+
+def import_peptides_and_preprocess(peptideCsvFileObject, fastaFileObject, validEnzymeList=[], cacheSize=MAPPING_CACHE_SIZE, customRules={}):
     """
     This function takes a format compliant CSV file object, a fasta file object
-    and an enzyme regex dictionary containing n side and c side varriations
+    (or an indexed ProteinLibrary) and an enzyme regex dictionary containing n
+    side and c side varriations. A fasta file object is searched with the
+    enzyme regexes per peptide, a library answers from its site index
+
+    The protein mapping, context and cleavage matches are computed once per
+    (sequence, accession) pair and shared by every row repeating it, the
+    enzyme set is fixed for the call. Up to cacheSize pairs are remembered,
+    oldest first out; cacheSize=0 maps every row on its own. Peptides sharing
+    a pair also share their nMatches and cMatches lists
+
+    customRules = {"enzymeName": "specificity", ...} adds user enzymes, a
+    library answers them from a RuleIndexedLibrary (see with_custom_rules)
     """
-    if len(validEnzymeList) > 0:
-        enzymeRegexDictNC = {enzyme:enzymeListNC[enzyme] for enzyme in validEnzymeList if enzyme in enzymeListNC}
+    enzymeRegexDictNC = select_enzymes(validEnzymeList, customRules)
+    if isinstance(fastaFileObject, ProteinLibrary):
+        library = with_custom_rules(fastaFileObject, customRules)
+        proteinDict = library.proteinDict
     else:
-        enzymeRegexDictNC = enzymeListNC
-    proteinDict = {p.id:str(p.seq) for p in SeqIO.parse(fastaFileObject, "fasta")}
+        #indexing a whole library costs more than searching once per peptide
+        from Bio import SeqIO
+        library = None
+        proteinDict = {p.id:str(p.seq) for p in SeqIO.parse(fastaFileObject, "fasta")}
     firstLinePending = True
     peptideList = []
+    mappingCache = OrderedDict()
     
     headerDict = {"sequence":False, "intensity":False, "protein_id":False, "sample_id":False, "rt":False}
     secondaryHeaderDict = {"protein code": "protein_id", "name":"sequence", "file":"sample_id"}
@@ -163,15 +665,23 @@ def import_peptides_and_preprocess(peptideCsvFileObject, fastaFileObject, validE
             sampleId = splitLine[headerDict['sample_id']]
             proteinId = splitLine[headerDict['protein_id']]
         except:
-            print "what?"
             continue
-        peptide = Peptide(sequence = sequence,
-                          intensity = intensity,
-                          rt = rt,
-                          sampleId = sampleId,
-                          accession = proteinId,
-                          proteinDict = proteinDict,
-                          enzymeRegexDictNC = enzymeRegexDictNC)
+        mappingKey = (sequence, proteinId)
+        mappedPeptide = mappingCache.get(mappingKey)
+        if mappedPeptide is None:
+            mappedPeptide = Peptide(sequence = sequence,
+                                    accession = proteinId,
+                                    proteinDict = proteinDict,
+                                    enzymeRegexDictNC = enzymeRegexDictNC,
+                                    library = library)
+            if cacheSize > 0:
+                mappingCache[mappingKey] = mappedPeptide
+                if len(mappingCache) > cacheSize:
+                    mappingCache.popitem(last=False)
+        peptide = copy(mappedPeptide)
+        peptide.intensity = intensity
+        peptide.rt = rt
+        peptide.sampleId = sampleId
         peptideList.append(peptide)
     
     if len(peptideList) == 0:
@@ -179,21 +689,37 @@ def import_peptides_and_preprocess(peptideCsvFileObject, fastaFileObject, validE
     return peptideList
 
     
-def extract_data_from_processed_peptides(peptideList, validEnzymeList, method="sampleId", result="dictionary"): # extractOrderSet,
+def expected_site_counts(accessions, enzymes, library):
+    """
+    Returns {"enzymeName": int, ...}, the theoretical number of sites of every
+    enzyme summed over the given proteins of the library
+    """
+    expectedSites = {enzyme: 0 for enzyme in enzymes}
+    for accession in accessions:
+        for enzyme in enzymes:
+            expectedSites[enzyme] += library.site_count(accession, enzyme)
+    return expectedSites
+
+
+def extract_data_from_processed_peptides(peptideList, validEnzymeList, method="sampleId", result="dictionary", library=None, normalize=False, customRules={}): # extractOrderSet,
     """
     This function takes a format compliant CSV file object, a fasta file object
     and an enzyme regex dictionary containing n side and c side varriations
     
     method = "sampleId"  extracts by sample id
     method = "accession" extracts by protein
+
+    When a ProteinLibrary is given every group also receives an
+    "expectedSiteDict", the theoretical number of sites per enzyme summed over
+    the proteins observed in the group. normalize=True reports enzyme
+    responses per expected site instead of raw summed intensity
     """
-    if len(validEnzymeList) > 0:
-        enzymeDict = {enzyme:enzymeListNC[enzyme] for enzyme in validEnzymeList if enzyme in enzymeListNC}
-    else:
-        enzymeDict = enzymeListNC
+    if normalize and library is None:
+        raise ValueError("A protein library is required to normalize by expected sites")
+    enzymeDict = select_enzymes(validEnzymeList, customRules)
         
     outDict = {}
-    aaList = [ "A","G","P","V","L","I","M","C","F","Y","W","H","K","R","Q","N","E","D","S","T" ]                          
+    groupAccessions = {}
     
     for peptide in peptideList:
         attribute = getattr(peptide,method)
@@ -202,6 +728,8 @@ def extract_data_from_processed_peptides(peptideList, validEnzymeList, method="s
             outDict[attribute] = {"cSideOrphans":{ aa:0 for aa in aaList },
                                   "nSideOrphans":{ aa:0 for aa in aaList },
                                   "enzymeResponseDict":{ enzyme: 0 for enzyme in enzymeDict } }
+            groupAccessions[attribute] = set()
+        groupAccessions[attribute].add(peptide.accession)
         
         for enzyme in peptide.nMatches:
             outDict[attribute]["enzymeResponseDict"][enzyme] += peptide.intensity
@@ -217,88 +745,337 @@ def extract_data_from_processed_peptides(peptideList, validEnzymeList, method="s
             if peptide.contextSequence[-2] != '_':
                 outDict[attribute]["cSideOrphans"][peptide.contextSequence[-3]] += 0.5*peptide.intensity
                 outDict[attribute]["nSideOrphans"][peptide.contextSequence[-2]] += 0.5*peptide.intensity
+
+    if library is not None:
+        library = with_custom_rules(library, customRules)
+        for attribute in outDict:
+            expectedSites = expected_site_counts(groupAccessions[attribute], enzymeDict, library)
+            outDict[attribute]["expectedSiteDict"] = expectedSites
+            if normalize:
+                enzResponses = outDict[attribute]["enzymeResponseDict"]
+                for enzyme in enzResponses:
+                    if expectedSites[enzyme] > 0:
+                        enzResponses[enzyme] = enzResponses[enzyme] / float(expectedSites[enzyme])
             
     if result == "dictionary":
         return outDict
     
-    validAttributes = [attr for attr in outDict]
-    validEnzymes = [enz for enz in enzymeDict]
-    
-    enzList = copy(validEnzymes)
-    enzList.sort()
-    cola = [""] + enzList
-    colb = [aa+"-c-side" for aa in aaList]
-    colb.sort()
-    colc = [aa+"-n-side" for aa in aaList]
-    colc.sort
-    firstColumn = cola + colb + colc
-    columnList = [firstColumn]
-    for attr in validAttributes:
-        enzResponses = outDict[attr]["enzymeResponseDict"]
-        enzKeys = enzResponses.keys()
-        enzKeys.sort()
-        cSide = outDict[attr]["cSideOrphans"]
-        cKeys = cSide.keys()
-        cKeys.sort()
-        nSide = outDict[attr]["nSideOrphans"]
-        nKeys = nSide.keys()
-        nKeys.sort()
-        
-        nextColumn = [attr] + [enzResponses[enz] for enz in enzKeys]
-        nextColumn += [cSide[enz] for enz in cKeys]
-        nextColumn += [nSide[enz] for enz in nKeys]
-        columnList.append(nextColumn)
-    
-    newList = zip(*columnList)
-    newList = [list(tup) for tup in newList]
     if result == "list":
-        return newList
+        return list(iter_result_rows(outDict, enzymeDict.keys()))
+
+
+def result_fields(enzymes, expectedSites=False):
+    """
+    Returns the row names of a result table in order: the sorted enzymes,
+    then the c-side and the n-side orphan residues. expectedSites=True adds
+    the expected site count of every enzyme
+    """
+    residues = sorted(aaList)
+    fields = (sorted(enzymes) + [aa+"-c-side" for aa in residues]
+              + [aa+"-n-side" for aa in residues])
+    if expectedSites:
+        fields += [enzyme+"-expected-sites" for enzyme in sorted(enzymes)]
+    return fields
 
 
+def iter_group_records(outDict, enzymes, expectedSites=False):
+    """
+    Yields (group, values) for every group of an extracted outDict, values
+    follow result_fields(enzymes, expectedSites). Nothing beyond one group
+    is built at a time
+    """
+    enzymes = sorted(enzymes)
+    residues = sorted(aaList)
+    for group in outDict:
+        groupDict = outDict[group]
+        values = ([groupDict["enzymeResponseDict"][enz] for enz in enzymes]
+                  + [groupDict["cSideOrphans"][aa] for aa in residues]
+                  + [groupDict["nSideOrphans"][aa] for aa in residues])
+        if expectedSites:
+            values += [groupDict["expectedSiteDict"][enz] for enz in enzymes]
+        yield (group, values)
 
 
+def iter_result_rows(outDict, enzymes):
+    """
+    Yields the result="list" table one row at a time: a header of the
+    groups, then one row per result field holding its value in every group
+    """
+    groups = outDict.keys()
+    yield [""] + groups
+    enzymes = sorted(enzymes)
+    residues = sorted(aaList)
+    for enzyme in enzymes:
+        yield [enzyme] + [outDict[group]["enzymeResponseDict"][enzyme] for group in groups]
+    for side, key in (("-c-side", "cSideOrphans"), ("-n-side", "nSideOrphans")):
+        for aa in residues:
+            yield [aa+side] + [outDict[group][key][aa] for group in groups]
 
 
-"""if __name__ == "__main__":
-    import time
-    
-    t1 = time.time()
-    #present to user:
-    enzymeList = [enzyme for enzyme in enzymeListNC]
-    
-    #User input:
-    inputEnzymeList = ["Elastase", "Plasmin"] #any valid enzymes from enzymeList
-    testFile = "test_15mothers_degradome - Copy.csv"
-    #testFile = "test_15mothers_degradome.csv"
-    testFile = open(testFile, 'r')
-    
-    
-    #prepare output after successfull request
-    fastaLibraryFile = open("degradomeLibrary.fasta", "r")
-    #peptideList = import_peptides_and_preprocess(testFile, fastaLibraryFile, inputEnzymeList)
-    try:
-        peptideList = import_peptides_and_preprocess(testFile, fastaLibraryFile, inputEnzymeList)
-    except Exception, e:
-        print e
-    try:
-        results = extract_data_from_processed_peptides(peptideList, enzymeListNC, result="list")
-    except Exception, e:
-        print e
-        
-    print "took {} seconds".format(time.time() - t1)"""
+RESAMPLE_BLOCK_SIZE = 2000000
+
+def _encode_peptides(peptideList, enzymes, method):
+    """
+    Integer-codes peptides for resampling; returns the group names, an array
+    of group codes and the sparse (peptide, enzyme, intensity) responses
+    """
+    import numpy as np
+    enzymeColumns = {enzyme: i for i, enzyme in enumerate(enzymes)}
+    groups, groupCodes = [], {}
+    codes = np.empty(len(peptideList), dtype=np.intp)
+    rows, columns, weights = [], [], []
+    for i, peptide in enumerate(peptideList):
+        attribute = getattr(peptide, method)
+        if attribute not in groupCodes:
+            groupCodes[attribute] = len(groups)
+            groups.append(attribute)
+        codes[i] = groupCodes[attribute]
+        for enzyme in peptide.nMatches + peptide.cMatches:
+            if enzyme in enzymeColumns:
+                rows.append(i)
+                columns.append(enzymeColumns[enzyme])
+                weights.append(peptide.intensity)
+    return (groups, codes, np.array(rows, dtype=np.intp),
+            np.array(columns, dtype=np.intp), np.array(weights, dtype=np.float64))
+
+
+def _bootstrap_groups(args):
+    """
+    Bootstraps peptides within each of the given groups, returns the
+    percentile confidence interval of every enzyme response per group
+    """
+    import numpy as np
+    groupMembers, enzymeCount, iterations, alpha, seed = args
+    randomState = np.random.RandomState(seed)
+    intervals = []
+    for members in groupMembers:
+        peptideCount = members.shape[0]
+        samples = np.empty((iterations, enzymeCount))
+        batch = max(1, RESAMPLE_BLOCK_SIZE // peptideCount)
+        for first in range(0, iterations, batch):
+            size = min(batch, iterations - first)
+            draws = randomState.randint(0, peptideCount, size=(size, peptideCount))
+            draws += (np.arange(size) * peptideCount)[:, None]
+            drawCounts = np.bincount(draws.ravel(), minlength=size*peptideCount)
+            samples[first:first+size] = drawCounts.reshape(size, peptideCount).dot(members)
+        intervals.append(np.percentile(samples, [50.0*alpha, 100.0 - 50.0*alpha], axis=0))
+    return intervals
+
+
+def _permute_labels(args):
+    """
+    Permutes group labels across peptides, returns per group and enzyme the
+    number of permutations at least as extreme as the observed response
+    """
+    import numpy as np
+    codes, rows, columns, weights, groupCount, enzymeCount, observed, expected, iterations, seed = args
+    randomState = np.random.RandomState(seed)
+    observedDistance = np.abs(observed - expected).ravel() * (1 - 1e-9)
+    exceedCounts = np.zeros(groupCount*enzymeCount, dtype=np.int64)
+    for i in range(iterations):
+        labels = randomState.permutation(codes)[rows]
+        permuted = np.bincount(labels*enzymeCount + columns, weights=weights,
+                               minlength=groupCount*enzymeCount)
+        exceedCounts += np.abs(permuted - expected.ravel()) >= observedDistance
+    return exceedCounts.reshape(groupCount, enzymeCount)
+
+
+def resample_enzyme_responses(peptideList, validEnzymeList, method="sampleId", iterations=10000,
+                              alpha=0.05, processes=None, seed=None, customRules={},
+                              library=None, normalize=False):
+    """
+    This function estimates the confidence of the summed enzyme responses that
+    extract_data_from_processed_peptides reports. Peptides are bootstrapped
+    within each group for a percentile confidence interval and group labels
+    are permuted across peptides for a two sided p-value per group and enzyme
+
+    normalize=True (with a library) reports responses and intervals per
+    expected site of the group, as extract_data_from_processed_peptides does.
+    The divisor is fixed per group, so p-values do not change
+
+    processes = None uses every core, processes = 1 runs in this process
+    returns {"group": {"enzymeName": {"response":float, "ciLow":float,
+                                      "ciHigh":float, "pValue":float}, ...}, ...}
+    """
+    import numpy as np
+    if normalize and library is None:
+        raise ValueError("A protein library is required to normalize by expected sites")
+    enzymes = sorted(select_enzymes(validEnzymeList, customRules))
+    groups, codes, rows, columns, weights = _encode_peptides(peptideList, enzymes, method)
+    groupCount, enzymeCount = len(groups), len(enzymes)
+
+    #dense per peptide responses, only needed for the within group bootstrap
+    responses = np.zeros((len(codes), enzymeCount))
+    np.add.at(responses, (rows, columns), weights)
+    observed = np.bincount(codes[rows]*enzymeCount + columns, weights=weights,
+                           minlength=groupCount*enzymeCount).reshape(groupCount, enzymeCount)
+    groupSizes = np.bincount(codes, minlength=groupCount)
+    expected = np.outer(groupSizes / float(len(codes)), observed.sum(axis=0))
+
+    if processes is None:
+        processes = cpu_count()
+    taskCount = max(1, processes)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=2*taskCount)
+    groupMembers = [responses[codes == g] for g in range(groupCount)]
+    bootstrapTasks = [(groupMembers[t::taskCount], enzymeCount, iterations, alpha, seeds[t])
+                      for t in range(taskCount)]
+    permutationTasks = [(codes, rows, columns, weights, groupCount, enzymeCount, observed, expected,
+                         iterations // taskCount + (1 if t < iterations % taskCount else 0), seeds[taskCount+t])
+                        for t in range(taskCount)]
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            bootstrapResults = pool.map(_bootstrap_groups, bootstrapTasks)
+            permutationResults = pool.map(_permute_labels, permutationTasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        bootstrapResults = map(_bootstrap_groups, bootstrapTasks)
+        permutationResults = map(_permute_labels, permutationTasks)
+
+    intervals = [None] * groupCount
+    for t in range(taskCount):
+        intervals[t::taskCount] = bootstrapResults[t]
+    pValues = (sum(permutationResults) + 1) / float(iterations + 1)
+
+    scales = np.ones((groupCount, enzymeCount))
+    if normalize:
+        library = with_custom_rules(library, customRules)
+        groupAccessions = [set() for group in groups]
+        for code, peptide in zip(codes, peptideList):
+            groupAccessions[code].add(peptide.accession)
+        for g in range(groupCount):
+            expectedSites = expected_site_counts(groupAccessions[g], enzymes, library)
+            for e, enzyme in enumerate(enzymes):
+                if expectedSites[enzyme] > 0:
+                    scales[g, e] = 1.0 / expectedSites[enzyme]
+
+    outDict = {}
+    for g, group in enumerate(groups):
+        outDict[group] = {}
+        for e, enzyme in enumerate(enzymes):
+            outDict[group][enzyme] = {"response": observed[g, e] * scales[g, e],
+                                      "ciLow": intervals[g][0][e] * scales[g, e],
+                                      "ciHigh": intervals[g][1][e] * scales[g, e],
+                                      "pValue": pValues[g, e]}
+    return outDict
+
+
+def resampling_table(resampledDict):
+    """
+    Flattens the output of resample_enzyme_responses into a list of rows
+    with a header row
+    """
+    rows = [["Group", "Enzyme", "Response", "CI low", "CI high", "p-value"]]
+    groups = resampledDict.keys()
+    groups.sort()
+    for group in groups:
+        enzymes = resampledDict[group].keys()
+        enzymes.sort()
+        for enzyme in enzymes:
+            stats = resampledDict[group][enzyme]
+            rows.append([group, enzyme, stats["response"], stats["ciLow"], stats["ciHigh"], stats["pValue"]])
+    return rows
+
+
+
+
+
+
+
+def _position_labels(width):
+    return ["P{}".format(i) for i in range(width, 0, -1)] + ["P{}'".format(i) for i in range(1, width+1)]
+
+
+def residue_frequency_matrices(peptideList, library, method="sampleId", width=4, orphansOnly=False):
+    """
+    This function builds intensity weighted position x residue matrices from
+    the Pwidth..Pwidth' window around each peptide terminus, in one pass over
+    all peptides. Chain termini and non standard residues are not counted
+
+    orphansOnly = True only counts termini without an enzyme match
+    returns {"group": {"nTerm": array, "cTerm": array}, ...} where the arrays
+             have one row per position (see _position_labels) and one column
+             per residue in aaList
+    """
+    import numpy as np
+    peptides = [peptide for peptide in peptideList if peptide.contextSequence is not None]
+    #concatenate the observed proteins, each padded by width, so every window is a plain slice
+    accessionOffsets, paddedParts, offset = {}, [], 0
+    for peptide in peptides:
+        if peptide.accession not in accessionOffsets:
+            accessionOffsets[peptide.accession] = offset + width
+            paddedPart = "_"*width + str(library.proteinDict[peptide.accession]) + "_"*width
+            paddedParts.append(paddedPart)
+            offset += len(paddedPart)
+    residueCodes = np.full(256, -1, dtype=np.intp)
+    for i, aa in enumerate(aaList):
+        residueCodes[ord(aa)] = i
+    libraryCodes = residueCodes[np.frombuffer("".join(paddedParts), dtype=np.uint8)]
+
+    groups, groupCodes = [], {}
+    codes = np.empty(len(peptides), dtype=np.intp)
+    proteinOffsets = np.empty(len(peptides), dtype=np.intp)
+    starts = np.empty(len(peptides), dtype=np.intp)
+    ends = np.empty(len(peptides), dtype=np.intp)
+    intensities = np.empty(len(peptides))
+    nOrphan = np.empty(len(peptides), dtype=bool)
+    cOrphan = np.empty(len(peptides), dtype=bool)
+    for i, peptide in enumerate(peptides):
+        attribute = getattr(peptide, method)
+        if attribute not in groupCodes:
+            groupCodes[attribute] = len(groups)
+            groups.append(attribute)
+        codes[i] = groupCodes[attribute]
+        proteinOffsets[i] = accessionOffsets[peptide.accession]
+        starts[i] = peptide.start
+        ends[i] = peptide.end
+        intensities[i] = peptide.intensity
+        nOrphan[i] = len(peptide.nMatches) < 1
+        cOrphan[i] = len(peptide.cMatches) < 1
+
+    positionCount, residueCount = 2*width, len(aaList)
+    cellCount = len(groups)*positionCount*residueCount
+    positionColumns = np.arange(-width, width)
+    matrices = {}
+    for terminus, sites, orphans in (("nTerm", starts, nOrphan), ("cTerm", ends, cOrphan)):
+        selected = orphans if orphansOnly else np.ones(len(peptides), dtype=bool)
+        windows = libraryCodes[(proteinOffsets + sites)[selected][:, None] + positionColumns]
+        cells = (codes[selected][:, None]*positionCount + np.arange(positionCount))*residueCount + windows
+        cellWeights = np.repeat(intensities[selected], positionCount)
+        counted = windows.ravel() >= 0
+        matrices[terminus] = np.bincount(cells.ravel()[counted], weights=cellWeights[counted],
+                                         minlength=cellCount).reshape(len(groups), positionCount, residueCount)
+
+    return {group: {"nTerm": matrices["nTerm"][g], "cTerm": matrices["cTerm"][g]}
+            for g, group in enumerate(groups)}
+
+
+def frequency_matrix_rows(matrixDict, width=4, normalize=False):
+    """
+    Flattens the output of residue_frequency_matrices into table rows, one per
+    group, terminus and position. normalize=True scales every position to sum
+    to one, the position frequency matrix expected by sequence logo tools
+    """
+    import numpy as np
+    rows = [["Group", "Terminus", "Position"] + aaList]
+    positionLabels = _position_labels(width)
+    groups = matrixDict.keys()
+    groups.sort()
+    for group in groups:
+        for terminus in ("nTerm", "cTerm"):
+            matrix = matrixDict[group][terminus]
+            if normalize:
+                totals = matrix.sum(axis=1)[:, None]
+                matrix = np.where(totals > 0, matrix / np.where(totals > 0, totals, 1), 0)
+            for position, label in enumerate(positionLabels):
+                rows.append([group, terminus, label] + matrix[position].tolist())
+    return rows
 
 
 if __name__ == "__main__":
-    #from EnzymeCutQuantifier import extract_data_from_processed_peptides, import_peptides_and_preprocess
-    
-    fastaFile = open("degradomeLibrary.fasta", "r")
-    csvTestFile = open("test_15mothers_degradome.csv", 'r')
-    inputEnzymeList = ["Trypsin", "Elastase"]
-    peptideList = import_peptides_and_preprocess(csvTestFile, fastaFile, inputEnzymeList)
-    resultCSV = extract_data_from_processed_peptides(peptideList, inputEnzymeList, result = "list")
-    
-    import csv
-    import csv
-    with open('!output.csv', 'wb') as csvfile:
-        resultWriter = csv.writer(csvfile)
-        resultWriter.writerows(resultCSV)
+    #the batch command line lives in estimator_cli.py
+    import sys
+    from estimator_cli import main
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Benchmarks import_peptides_and_preprocess with and without the mapping
+cache on a synthetic degradome export in which every peptide is reported
+once per sample:
+
+    python fpaste/benchmark_mapping_cache.py --samples 1 5 20 50
+"""
+
+from StringIO import StringIO
+import argparse
+import random
+import time
+
+import PeptidomicsEnzymeEstimator as pee
+
+
+def synthetic_export(proteinCount, peptideCount, sampleCount, seed=0):
+    """
+    Returns a ProteinLibrary and the text of a peptide CSV reporting
+    peptideCount peptides in each of sampleCount samples
+    """
+    randomState = random.Random(seed)
+    proteinDict = {}
+    for i in range(proteinCount):
+        length = randomState.randint(100, 800)
+        proteinDict["P{:05d}".format(i)] = "".join(randomState.choice(pee.aaList) for _ in range(length))
+    accessions = sorted(proteinDict)
+    peptides = []
+    for i in range(peptideCount):
+        accession = randomState.choice(accessions)
+        start = randomState.randint(0, len(proteinDict[accession]) - 25)
+        peptides.append((proteinDict[accession][start:start+randomState.randint(6, 25)], accession))
+    lines = ["sequence,intensity,protein_id,sample_id,rt\n"]
+    for sample in range(sampleCount):
+        for sequence, accession in peptides:
+            lines.append("{},{:.1f},{},sample{},0\n".format(sequence, randomState.random()*1e6,
+                                                            accession, sample))
+    return pee.ProteinLibrary(proteinDict), "".join(lines)
+
+
+def time_import(csvText, library, cacheSize, repeats):
+    best = None
+    for i in range(repeats):
+        startTime = time.time()
+        pee.import_peptides_and_preprocess(StringIO(csvText), library, [], cacheSize=cacheSize)
+        elapsed = time.time() - startTime
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the peptide mapping cache")
+    parser.add_argument("--samples", type=int, nargs="+", default=[1, 5, 20, 50])
+    parser.add_argument("--proteins", type=int, default=500)
+    parser.add_argument("--peptides", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print "{:>8} {:>8} {:>12} {:>12} {:>8}".format("samples", "rows", "uncached s", "cached s", "speedup")
+    for sampleCount in args.samples:
+        library, csvText = synthetic_export(args.proteins, args.peptides, sampleCount)
+        uncached = time_import(csvText, library, 0, args.repeats)
+        cached = time_import(csvText, library, pee.MAPPING_CACHE_SIZE, args.repeats)
+        print "{:>8} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x".format(sampleCount, sampleCount*args.peptides,
+                                                               uncached, cached, uncached / cached)
+
+
+if __name__ == "__main__":
+    main()
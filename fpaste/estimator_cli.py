@@ -0,0 +1,255 @@
+"""
+Command line entry point for batch peptidomics enzyme estimation, runs the
+same functions as /enzyme_analysis without the web app:
+
+    python fpaste/estimator_cli.py --fasta library.fasta -e Trypsin -e Elastase \
+        -m sampleId -p 16 -o results.csv "runs/*.csv"
+
+Every peptide CSV is analyzed by a worker process and its groups are
+streamed to the output as soon as the file is done, one row (csv) or one
+object (ndjson) per group, or collected into a numpy archive (npz). Progress
+and per stage timings go to stderr.
+"""
+
+from multiprocessing import Pool, cpu_count
+from glob import glob
+import argparse
+import sys
+import time
+
+import PeptidomicsEnzymeEstimator as pee
+import resultexport
+
+
+#the library is loaded once in the parent and inherited by forked workers
+_workerLibrary = None
+
+def _init_worker(library):
+    global _workerLibrary
+    _workerLibrary = library
+
+
+def _analyze_file(args):
+    """
+    Runs import and extraction for one peptide CSV in a worker, returns
+    (path, outDict or None, error message, peptide count, timings, matrix rows)
+    matrix rows are None or {"weights": rows, "frequencies": rows}
+    """
+    csvPath, enzymes, method, normalize, customRules, matrices = args
+    timings = {}
+    matrixRows = None
+    library = pee.with_custom_rules(_workerLibrary, customRules)
+    try:
+        startTime = time.time()
+        with open(csvPath, "rU") as csvFile:
+            peptideList = pee.import_peptides_and_preprocess(csvFile, library, enzymes,
+                                                             customRules=customRules)
+        timings["import"] = time.time() - startTime
+        startTime = time.time()
+        outDict = pee.extract_data_from_processed_peptides(peptideList, enzymes, method=method,
+                                                           library=library, normalize=normalize,
+                                                           customRules=customRules)
+        timings["extract"] = time.time() - startTime
+        if matrices:
+            startTime = time.time()
+            matrixDict = pee.residue_frequency_matrices(peptideList, library, method=method)
+            matrixRows = {"weights": pee.frequency_matrix_rows(matrixDict),
+                          "frequencies": pee.frequency_matrix_rows(matrixDict, normalize=True)}
+            timings["matrices"] = time.time() - startTime
+    except Exception, e:
+        return (csvPath, None, str(e), 0, timings, None)
+    return (csvPath, outDict, "", len(peptideList), timings, matrixRows)
+
+
+class GroupWriter(object):
+    """
+    Streams analysis groups to a file object in one of the
+    resultexport.EXPORT_FORMATS, one record per (file, group)
+    """
+
+    labels = ["file", "group"]
+
+    def __init__(self, fileObject, enzymes, outputFormat="csv"):
+        self.fileObject = fileObject
+        self.fields = pee.result_fields(enzymes, expectedSites=True)
+        self.outputFormat = outputFormat
+
+    def write(self, records):
+        """
+        Writes ([file, group], values) records as they are produced
+        """
+        if self.outputFormat == "npz":
+            resultexport.write_npz(self.labels, self.fields, records, self.fileObject)
+            return
+        if self.outputFormat == "csv":
+            lines = resultexport.iter_csv(self.labels, self.fields, records)
+        else:
+            lines = resultexport.iter_ndjson(self.labels, self.fields, records)
+        for line in lines:
+            self.fileObject.write(line)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Estimate enzyme activity from peptidomics CSV files")
+    parser.add_argument("csvPaths", nargs="*", metavar="CSV",
+                        help="peptide CSV files or glob patterns")
+    parser.add_argument("--fasta", help="protein library in fasta format")
+    parser.add_argument("--library", metavar="BASE",
+                        help="memory mapped library (BASE.seq/.sites/.idx), exported from --fasta "
+                             "if it does not exist yet")
+    parser.add_argument("-e", "--enzyme", dest="enzymes", action="append", default=[],
+                        help="enzyme to score, may be repeated (default: all enzymes)")
+    parser.add_argument("-r", "--rule", dest="rules", action="append", default=[], metavar="NAME=SPEC",
+                        help="custom enzyme from a cleavage rule such as Trypsin2=.[KR]|[^P]., may be repeated")
+    parser.add_argument("-m", "--method", choices=["sampleId", "accession"], default="sampleId",
+                        help="group peptides by sample id or by protein")
+    parser.add_argument("-p", "--processes", type=int, default=cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+    parser.add_argument("-f", "--format", dest="outputFormat", choices=resultexport.EXPORT_FORMATS, default="csv",
+                        help="csv or ndjson are streamed per group, npz needs --output")
+    parser.add_argument("--matrices", metavar="PREFIX",
+                        help="also write the intensity weighted P4-P4' residue matrices to PREFIX-weights.csv "
+                             "and their per position frequencies (sequence logo input) to PREFIX-frequencies.csv")
+    parser.add_argument("--normalize", action="store_true",
+                        help="report enzyme responses per theoretical cleavage site")
+    parser.add_argument("--cache-dir", dest="cacheDir", default=None,
+                        help="directory to persist the indexed protein library in")
+    parser.add_argument("--list-enzymes", dest="listEnzymes", action="store_true",
+                        help="print the available enzymes and exit")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not report progress")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    enzymeTables = pee.compile_enzyme_tables()
+    if args.listEnzymes:
+        for enzyme in sorted(enzymeTables):
+            print enzyme
+        return 0
+
+    def report(message):
+        if not args.quiet:
+            sys.stderr.write(message + "\n")
+
+    if args.fasta is None and args.library is None:
+        sys.stderr.write("a protein library is required (--fasta or --library)\n")
+        return 2
+    unknownEnzymes = [enzyme for enzyme in args.enzymes if enzyme not in enzymeTables]
+    if len(unknownEnzymes) > 0:
+        sys.stderr.write("unknown enzymes: {}\n".format(", ".join(unknownEnzymes)))
+        return 2
+    customRules = {}
+    for rule in args.rules:
+        name, _, specificity = rule.partition("=")
+        try:
+            pee.parse_enzyme_rule(specificity)
+        except ValueError, e:
+            sys.stderr.write("invalid rule {}: {}\n".format(rule, e))
+            return 2
+        customRules[pee.custom_enzyme_name(name.strip(), specificity.strip())] = specificity.strip()
+    if len(args.enzymes) > 0 or len(customRules) > 0:
+        enzymes = args.enzymes
+    else:
+        enzymes = sorted(enzymeTables)
+    csvPaths = []
+    for pattern in args.csvPaths:
+        matches = sorted(glob(pattern))
+        if len(matches) == 0:
+            sys.stderr.write("no files match {}\n".format(pattern))
+            return 2
+        csvPaths += [match for match in matches if match not in csvPaths]
+    if len(csvPaths) == 0:
+        sys.stderr.write("no peptide CSV files were given\n")
+        return 2
+
+    totalStart = time.time()
+    if args.library is not None:
+        def records():
+            from Bio import SeqIO
+            with open(args.fasta, "rU") as fastaFile:
+                for protein in SeqIO.parse(fastaFile, "fasta"):
+                    yield (protein.id, str(protein.seq))
+        try:
+            library = pee.open_mapped_library(args.library, records=records if args.fasta else None)
+        except LookupError, e:
+            sys.stderr.write("{}\n".format(e))
+            return 2
+    else:
+        with open(args.fasta, "rU") as fastaFile:
+            library = pee.load_protein_library(fastaFile.read(), cacheDir=args.cacheDir)
+    libraryTime = time.time() - totalStart
+    report("library: {} proteins in {:.2f}s".format(len(library.proteinDict), libraryTime))
+
+    if args.output == "-":
+        if args.outputFormat == "npz":
+            sys.stderr.write("npz output has to be written to a file (--output)\n")
+            return 2
+        outputFile = sys.stdout
+    else:
+        outputFile = open(args.output, "w" if args.outputFormat == "ndjson" else "wb")
+    allEnzymes = enzymes + sorted(customRules)
+    writer = GroupWriter(outputFile, allEnzymes, args.outputFormat)
+    tasks = [(csvPath, enzymes, args.method, args.normalize, customRules, args.matrices is not None)
+             for csvPath in csvPaths]
+    processes = max(1, min(args.processes, len(tasks)))
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker, initargs=(library,))
+        results = pool.imap_unordered(_analyze_file, tasks)
+    else:
+        pool = None
+        _init_worker(library)
+        results = (_analyze_file(task) for task in tasks)
+
+    matrixFiles = {}
+    if args.matrices is not None:
+        for kind in ("weights", "frequencies"):
+            matrixFiles[kind] = open("{}-{}.csv".format(args.matrices, kind), "wb")
+
+    progress = {"failures": 0, "import": 0.0, "extract": 0.0, "matrices": 0.0}
+    def records():
+        for done, (csvPath, outDict, error, peptideCount, timings, matrixRows) in enumerate(results):
+            if outDict is None:
+                progress["failures"] += 1
+                report("[{}/{}] {}: failed: {}".format(done+1, len(tasks), csvPath, error))
+                continue
+            groupRecords = list(pee.iter_group_records(outDict, allEnzymes, expectedSites=True))
+            groupRecords.sort(key=lambda record: record[0])
+            for group, values in groupRecords:
+                yield ([csvPath, group], values)
+            outputFile.flush()
+            for kind in matrixFiles:
+                header, rows = matrixRows[kind][0], matrixRows[kind][1:]
+                lines = resultexport.iter_csv(["file"] + header[:3], header[3:],
+                                              (([csvPath] + row[:3], row[3:]) for row in rows),
+                                              header=matrixFiles[kind].tell() == 0)
+                for line in lines:
+                    matrixFiles[kind].write(line)
+            for stage in timings:
+                progress[stage] += timings[stage]
+            report("[{}/{}] {}: {} peptides, {} groups (import {:.2f}s, extract {:.2f}s)".format(
+                       done+1, len(tasks), csvPath, peptideCount, len(outDict),
+                       timings["import"], timings["extract"]))
+
+    try:
+        writer.write(records())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if outputFile is not sys.stdout:
+            outputFile.close()
+        for matrixFile in matrixFiles.values():
+            matrixFile.close()
+
+    failures = progress["failures"]
+    report("done: {} files, {} failed, {} processes; library {:.2f}s, import {:.2f}s, "
+           "extract {:.2f}s, matrices {:.2f}s (cpu), wall {:.2f}s".format(
+               len(tasks), failures, processes, libraryTime, progress["import"],
+               progress["extract"], progress["matrices"], time.time() - totalStart))
+    return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@ from flask.ext.wtf import Form
 from wtforms import Field, TextField, TextAreaField, BooleanField, RadioField, HiddenField, widgets, SelectMultipleField, PasswordField
 from wtforms.validators import Required, Length, ValidationError, Regexp, EqualTo
 from flask_wtf.file import FileRequired, FileField
+from PeptidomicsEnzymeEstimator import parse_enzyme_rule
 
 import re
 
@@ -105,8 +106,8 @@ class SingleFastaPaste(Form):
 class MakeListFromSelf(Form):
     """Accept lists and fastas to make a list """
     fastaList = TextField("fastaList", validators=[Regexp(r'(.){20}', message="Must be a single valid fasta list identifier")])
-    fastaAdd = CsvTextAreaField("fastas", validators=[Length(max=1000)])
-    fastaSubtract = CsvTextAreaField("fastaLists", validators=[Length(max=200)])
+    fastaAdd = CsvTextAreaField("fastas", validators=[Length(max=100000)])
+    fastaSubtract = CsvTextAreaField("fastaLists", validators=[Length(max=100000)])
 
 class UserLoginForm(Form):
     """Accept lists and fastas to make a list """
@@ -137,6 +138,24 @@ class MakeListFromUniprot(Form):
                                                  validate_uniprotList])
     cutSignalSeq = BooleanField("cutSignalSeq", default=False)
     
+class ValidateEnzymeRule(object):
+    """
+    checks that a specificity parses as an enzyme rule
+    """
+    def __call__(self, form, field):
+        try:
+            parse_enzyme_rule(field.data)
+        except ValueError, e:
+            raise ValidationError(str(e))
+
+class AddEnzymeRule(Form):
+    name = TextField("name", validators=[Required(),
+                                         Length(min=1, max=64),
+                                         Regexp(r'\A[^\[\]]*\Z', message="Brackets are not allowed in names")])
+    specificity = TextField("specificity", validators=[Required(),
+                                                       Length(min=1, max=256),
+                                                       ValidateEnzymeRule()])
+
 class AnalyzeEnzymeActivity(Form):
     fastaPlasteLibrary = TextField("fastaList", validators=[Regexp(r'(.){20}', message="Must be a single valid fasta list identifier")])
     selectedEnzymes = MultiCheckboxField("selectedEnzymes")
@@ -145,3 +164,6 @@ class AnalyzeEnzymeActivity(Form):
                                choices = [('sampleId', "Sample ID"),
                                           ('accession', "Protein")],
                                validators=[Required()])
+    normalizeBySites = BooleanField("normalizeBySites", default=False)
+    resampleSignificance = BooleanField("resampleSignificance", default=False)
+    positionMatrices = BooleanField("positionMatrices", default=False)
@@ -0,0 +1,51 @@
+from fpaste import app, db
+import models
+
+from sqlalchemy import event
+from threading import Lock
+import time
+
+"""process wide cache of users resolved from the session cookie"""
+
+class UserIdentityCache(object):
+    """
+    Keeps detached User objects for ttl seconds. get() returns a copy merged
+    into the current database session without a query on a hit, so
+    relationships still load as usual. Entries are dropped when a user row
+    is updated or deleted in this process, other processes see the change
+    once the ttl runs out
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._users = {}
+        self._lock = Lock()
+
+    def get(self, userId):
+        with self._lock:
+            entry = self._users.get(userId)
+        if entry is not None and entry[0] > time.time():
+            return db.session.merge(entry[1], load=False)
+        user = models.User.query.get(userId)
+        if user is None:
+            return None
+        #keep a detached instance that no session will expire or modify
+        db.session.expunge(user)
+        with self._lock:
+            self._users[userId] = (time.time() + self.ttl, user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, userId=None):
+        with self._lock:
+            if userId is None:
+                self._users.clear()
+            else:
+                self._users.pop(userId, None)
+
+
+identityCache = UserIdentityCache(ttl=app.config.get("USER_CACHE_TTL", 300))
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_user(mapper, connection, target):
+    identityCache.invalidate(target.id)
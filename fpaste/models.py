@@ -20,6 +20,7 @@ class User(db.Model):
     
     fastas = db.relationship("FastaEntry", backref="user", lazy="dynamic")
     fastaLists = db.relationship("FastaList", backref="user", lazy="dynamic")
+    enzymeRules = db.relationship("EnzymeRule", backref="user", lazy="dynamic")
     
     def new_password(self, plaintextPw, rounds=10):
         salt = unicode(''.join(choice(letters) for x in range(10)))
@@ -106,3 +107,23 @@ class FastaList(db.Model):
     fastas = db.relationship("FastaEntry", secondary=list_to_fasta,
                               backref=db.backref("fastaLists", lazy=True))
     
+
+class AnalysisResult(db.Model):
+    __tablename__ = "analysis_result"
+    id = db.Column(db.Integer, primary_key = True)
+    accessCode = db.Column(db.String(64), index = True, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    added = db.Column(db.DateTime, index = True)
+    method = db.Column(db.String(16))
+    #json {"tableName": {"labels": [...], "fields": [...], "records": [[labelValues, values], ...]}, ...}
+    data = db.Column(db.Text)
+
+
+class EnzymeRule(db.Model):
+    __tablename__ = "enzyme_rule"
+    id = db.Column(db.Integer, primary_key = True)
+    name = db.Column(db.String(64))
+    #P2-P2' specificity, see PeptidomicsEnzymeEstimator.parse_enzyme_rule
+    specificity = db.Column(db.String(256))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index = True)
+    added = db.Column(db.DateTime)
@@ -0,0 +1,82 @@
+from cStringIO import StringIO
+import csv
+import json
+
+"""
+streaming csv, ndjson and npz writers for enzyme analysis results
+
+Every writer takes the labels identifying a record (eg. ["group"] or
+["file", "group"]), the result fields (PeptidomicsEnzymeEstimator.result_fields)
+and an iterable of (labelValues, values) records, one per group, such as
+PeptidomicsEnzymeEstimator.iter_group_records or resultstore.iter_table_records
+"""
+
+EXPORT_FORMATS = ["csv", "ndjson", "npz"]
+CONTENT_TYPES = {"csv": "text/csv",
+                 "ndjson": "application/x-ndjson",
+                 "npz": "application/octet-stream"}
+
+#rows of the npz value matrix are filled in blocks of this many records
+NPZ_BLOCK_SIZE = 4096
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def iter_csv(labels, fields, records, header=True):
+    """
+    Yields the records as csv text, one line per record
+    """
+    lineBuffer = StringIO()
+    writer = csv.writer(lineBuffer)
+    if header:
+        writer.writerow([_encode(name) for name in labels + fields])
+    for labelValues, values in records:
+        writer.writerow([_encode(label) for label in labelValues] + values)
+        yield lineBuffer.getvalue()
+        lineBuffer.seek(0)
+        lineBuffer.truncate()
+    if lineBuffer.tell() > 0:
+        yield lineBuffer.getvalue()
+
+
+def iter_ndjson(labels, fields, records):
+    """
+    Yields one json object per record holding its labels and every field
+    """
+    for labelValues, values in records:
+        record = dict(zip(labels, labelValues))
+        record.update(zip(fields, values))
+        yield json.dumps(record) + "\n"
+
+
+def write_npz(labels, fields, records, fileObject):
+    """
+    Writes the records to fileObject as a compressed numpy archive holding
+    "labels", "fields", one array "label_<name>" per label and the float64
+    matrix "values" with one row per record. fileObject has to be seekable
+    """
+    import numpy as np
+    labelColumns = [[] for label in labels]
+    blocks = []
+    block = np.empty((NPZ_BLOCK_SIZE, len(fields)), dtype=np.float64)
+    filled = 0
+    for labelValues, values in records:
+        for column, label in zip(labelColumns, labelValues):
+            column.append(label)
+        block[filled] = values
+        filled += 1
+        if filled == NPZ_BLOCK_SIZE:
+            blocks.append(block)
+            block = np.empty((NPZ_BLOCK_SIZE, len(fields)), dtype=np.float64)
+            filled = 0
+    blocks.append(block[:filled])
+    #prefixed, so labels never clash with the other arrays or savez's own arguments
+    arrays = {"label_" + label: np.array(column, dtype=np.unicode_) for label, column in zip(labels, labelColumns)}
+    arrays["labels"] = np.array(labels, dtype=np.unicode_)
+    arrays["fields"] = np.array(fields, dtype=np.unicode_)
+    arrays["values"] = np.concatenate(blocks)
+    np.savez_compressed(fileObject, **arrays)
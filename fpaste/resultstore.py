@@ -0,0 +1,157 @@
+from fpaste import app, db
+import models
+
+from collections import OrderedDict
+from hashlib import sha256
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta
+from random import random
+import json
+
+"""
+storage and server side paging of enzyme analysis result tables
+
+An analysis stores named record tables {"labels": [...], "fields": [...],
+"records": [[labelValues, values], ...]}: "results" holds one record per
+group, "significance" the optional resampling table and "positions" and
+"position_frequencies" the optional P4-P4' matrices as weights and as per
+position frequencies. Records are the (labels, values) pairs the
+resultexport writers take
+"""
+
+MAX_PAGE_ROWS = 500
+MAX_PAGE_COLUMNS = 200
+RESULT_CACHE_SIZE = 16
+
+#results never change once stored, so decoded tables can be kept per process
+_resultCache = OrderedDict()
+
+
+def record_table(labels, fields, records):
+    """
+    Builds a storable table from (labelValues, values) records
+    """
+    return {"labels": list(labels),
+            "fields": list(fields),
+            "records": [[list(labelValues), list(values)] for labelValues, values in records]}
+
+
+def rows_table(rows, labelCount):
+    """
+    Builds a storable table from a header row and data rows whose first
+    labelCount columns label the record, eg. the output of resampling_table
+    """
+    header = rows[0]
+    return record_table(header[:labelCount], header[labelCount:],
+                        ((row[:labelCount], row[labelCount:]) for row in rows[1:]))
+
+
+def _expiry_cutoff():
+    return datetime.utcnow() - timedelta(seconds=app.config.get("RESULT_TTL", 7*24*3600))
+
+
+def purge_expired():
+    """
+    Deletes the stored results older than RESULT_TTL seconds
+    """
+    models.AnalysisResult.query.filter(models.AnalysisResult.added < _expiry_cutoff()) \
+                               .delete(synchronize_session=False)
+
+
+def store_result(tables, method, userId=None):
+    """
+    Stores the {"tableName": table, ...} of one analysis and returns the
+    access code they are served under, expired results are purged first
+    """
+    purge_expired()
+    accessCode = urlsafe_b64encode(sha256(str(random())+str(random())).digest())[0:20]
+    added = datetime.utcnow()
+    result = models.AnalysisResult(accessCode = accessCode,
+                                   user_id = userId,
+                                   added = added,
+                                   method = method,
+                                   data = json.dumps(tables))
+    db.session.add(result)
+    db.session.commit()
+    _remember(accessCode, (added, tables))
+    return accessCode
+
+
+def load_result(accessCode, tableName="results"):
+    """
+    Returns one stored table of an analysis, or None when the analysis,
+    the table or the analysis' lifetime does not exist
+    """
+    if accessCode in _resultCache:
+        entry = _resultCache.pop(accessCode)
+    else:
+        result = models.AnalysisResult.query.filter_by(accessCode = accessCode).first()
+        if result is None:
+            return None
+        entry = (result.added, json.loads(result.data))
+    if entry[0] < _expiry_cutoff():
+        return None
+    _remember(accessCode, entry)
+    return entry[1].get(tableName)
+
+
+def _remember(accessCode, entry):
+    _resultCache[accessCode] = entry
+    while len(_resultCache) > RESULT_CACHE_SIZE:
+        _resultCache.popitem(last=False)
+
+
+def record_key(labelValues):
+    return u" / ".join(unicode(label) for label in labelValues)
+
+
+def iter_table_records(table):
+    """
+    Yields the (labelValues, values) records of a stored table, the form the
+    resultexport writers take
+    """
+    for labelValues, values in table["records"]:
+        yield (labelValues, values)
+
+
+def page_result(table, rowStart=0, rowCount=50, colStart=0, colCount=20,
+                groups=None, sortRows=None, sortColumns=None, descending=False):
+    """
+    Returns one page of a stored table, one row per record and one column
+    per field. groups keeps the records whose first label is listed,
+    sortRows orders the records by the values of one field and sortColumns
+    orders the fields by the values of one record (see record_key). Raises
+    KeyError for unknown field or record names
+    """
+    fieldIndex = {name: i for i, name in enumerate(table["fields"])}
+    records = table["records"]
+    if groups:
+        groups = set(unicode(group) for group in groups)
+        rowOrder = [r for r, record in enumerate(records) if unicode(record[0][0]) in groups]
+    else:
+        rowOrder = range(len(records))
+    columnOrder = range(len(table["fields"]))
+    if sortRows is not None:
+        sortField = fieldIndex[sortRows]
+        rowOrder.sort(key=lambda r: records[r][1][sortField], reverse=descending)
+    if sortColumns is not None:
+        keys = [r for r, record in enumerate(records) if record_key(record[0]) == sortColumns]
+        if len(keys) == 0:
+            raise KeyError(sortColumns)
+        sortValues = records[keys[0]][1]
+        columnOrder.sort(key=lambda c: sortValues[c], reverse=descending)
+
+    rowCount = max(0, min(rowCount, MAX_PAGE_ROWS))
+    colCount = max(0, min(colCount, MAX_PAGE_COLUMNS))
+    #negative offsets would slice from the end of the table
+    rowStart = max(0, rowStart)
+    colStart = max(0, colStart)
+    pageRows = rowOrder[rowStart:rowStart+rowCount]
+    pageColumns = columnOrder[colStart:colStart+colCount]
+    return {"totalRows": len(rowOrder),
+            "totalColumns": len(columnOrder),
+            "rowStart": rowStart,
+            "colStart": colStart,
+            "labels": table["labels"],
+            "columns": [table["fields"][c] for c in pageColumns],
+            "rows": [records[r][0] + [records[r][1][c] for c in pageColumns] for r in pageRows]}
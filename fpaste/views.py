@@ -1,22 +1,32 @@
-from flask import render_template, flash, redirect, session, Response, url_for, g
+from flask import render_template, flash, redirect, session, Response, url_for, g, request, stream_with_context, send_file
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from fpaste import app, db, lm
 import forms
 from models import FastaEntry
 import models 
-import ioroutines as ior
 import PeptidomicsEnzymeEstimator as pee
+import resultstore
+import resultexport
+from identitycache import identityCache
+
+from sqlalchemy import and_, select
 
 from hashlib import sha256
 from base64 import urlsafe_b64encode
 from datetime import datetime
 from random import random
-from StringIO import StringIO
+from os import path
+from glob import glob
+from tempfile import TemporaryFile
 import json
 
 @lm.user_loader
 def load_user(id):
-    return models.User.query.get(int(id))
+    #before_request has usually resolved this user for the request already
+    user = getattr(g, "user", None)
+    if user is not None and user.id == int(id):
+        return user
+    return identityCache.get(int(id))
 
 #@lm.needs_refresh_handler
 #def refresh():
@@ -26,8 +36,9 @@ def load_user(id):
 @app.before_request
 def before_request():
     userLoggedIn = False
+    g.user = None
     if 'user_id' in session:
-        g.user = models.User.query.get(int(session['user_id']))
+        g.user = identityCache.get(int(session['user_id']))
         if g.user is not None:
             userLoggedIn = True
     g.userLoggedIn = userLoggedIn
@@ -69,19 +80,16 @@ def make_list():
             idCode = urlsafe_b64encode(sha256(user.nickname+str(random())+str(random())).digest())[0:20]
             newFastaList = models.FastaList(accessCode = idCode, user_id = user.id, added = datetime.utcnow())
             db.session.add(newFastaList)
+            db.session.flush()
             outputMessage = "Fasta list {} has been created".format(newFastaList.accessCode)
         else:
             outputMessage = "Fasta list {} has been modified".format(newFastaList.accessCode)
-        #Process lists for added fastas and removed fastas
-        for access in form.fastaAdd.data:
-            entry = models.FastaEntry.query.filter_by(accessCode = access).first()
-            if entry is not None:
-                newFastaList.fastas.append(entry)
-        for fasta in newFastaList.fastas:
-            accessCode = fasta.accessCode
-            if accessCode in form.fastaSubtract.data:
-                delIndex = newFastaList.fastas.index(fasta)
-                del(newFastaList.fastas[delIndex])
+        #Process lists for added fastas and removed fastas as sets of list_to_fasta rows,
+        #without loading the list's relationship
+        subtractCodes = set(code for code in form.fastaSubtract.data if code)
+        addCodes = set(code for code in form.fastaAdd.data if code) - subtractCodes
+        add_to_fasta_list(newFastaList.id, list(addCodes))
+        remove_from_fasta_list(newFastaList.id, list(subtractCodes))
         form.fastaList.data = ""
         form.fastaAdd.data = []
         form.fastaSubtract.data = []
@@ -90,12 +98,44 @@ def make_list():
     return render_template('make_list.html', form=form)
 
 
+def add_to_fasta_list(fastaListId, accessCodes):
+    """
+    Adds the fasta entries with the given access codes to a fasta list,
+    skipping unknown codes and entries that are already members
+    """
+    membership = models.list_to_fasta
+    for codes in _chunks(accessCodes):
+        fastaIds = set(row[0] for row in db.session.query(models.FastaEntry.id)
+                                             .filter(models.FastaEntry.accessCode.in_(codes)))
+        if len(fastaIds) == 0:
+            continue
+        presentIds = set(row[0] for row in db.session.execute(
+                            select([membership.c.fasta])
+                            .where(and_(membership.c.fastaList == fastaListId,
+                                        membership.c.fasta.in_(list(fastaIds))))))
+        newRows = [{"fasta": fastaId, "fastaList": fastaListId} for fastaId in fastaIds - presentIds]
+        if len(newRows) > 0:
+            db.session.execute(membership.insert(), newRows)
+
+def remove_from_fasta_list(fastaListId, accessCodes):
+    """
+    Removes the fasta entries with the given access codes from a fasta list
+    """
+    membership = models.list_to_fasta
+    for codes in _chunks(accessCodes):
+        fastaIds = select([models.FastaEntry.id]).where(models.FastaEntry.accessCode.in_(codes))
+        db.session.execute(membership.delete()
+                           .where(and_(membership.c.fastaList == fastaListId,
+                                       membership.c.fasta.in_(fastaIds))))
+
+
 @app.route('/import_uniprot', methods = ['GET', 'POST'])
 @login_required
 def import_uniprot():
     form = forms.MakeListFromUniprot()
     errors = []
     if form.validate_on_submit() and g.userLoggedIn:
+        import ioroutines as ior
         user = g.user
         cutSignalSeq = form.cutSignalSeq.data
         ids = form.uniprotIds.data
@@ -212,17 +252,7 @@ def render_fasta_list(fastalist_id, returnFastaText=False):
     if fastaList is None:
         fastaReturn = "notfound"
     else:
-        fastaReturn = ""
-        for fasta in fastaList.fastas:
-            fastaReturn += ">" + fasta.accession + " " + fasta.metaData + "\n"
-            counter = 0
-            for char in fasta.sequence:
-                counter += 1
-                fastaReturn += char
-                if counter % 80 == 0:
-                    counter = 0
-                    fastaReturn += "\n"
-            fastaReturn += "\n"
+        fastaReturn = "".join(format_fasta_entry(fasta) for fasta in fastaList.fastas)
     #this can be called as a text getter
     if returnFastaText:
         return fastaReturn
@@ -236,42 +266,130 @@ def render_fasta_file(fasta_id):
     if fasta is None:
         fastaReturn = ""
     else:
-        fastaReturn = ">" + fasta.accession + " " + fasta.metaData + "\n"
-        counter = 0
-        for char in fasta.sequence:
-            counter += 1
-            fastaReturn += char
-            if counter % 80 == 0:
-                counter = 0
-                fastaReturn += "\n"
+        fastaReturn = format_fasta_entry(fasta)
     return Response(fastaReturn, content_type="text/plain;charset=UTF-8")
 
+@app.route("/fasta_bulk", methods = ['GET', 'POST'])
+def render_fasta_bulk():
+    """
+    Streams many fasta entries and fasta lists as one document, each entry
+    once. Arguments: entries and lists (comma separated access codes) and
+    format ("fasta" or "ndjson")
+    """
+    entryCodes = _split_codes(request.values.get("entries", ""))
+    listCodes = _split_codes(request.values.get("lists", ""))
+    outputFormat = request.values.get("format", "fasta")
+    if outputFormat not in ("fasta", "ndjson"):
+        return Response("unknown format", status=400, content_type="text/plain;charset=UTF-8")
+
+    def generate():
+        sentCodes = set()
+        for fasta in iter_bulk_fastas(entryCodes, listCodes):
+            if fasta.accessCode in sentCodes:
+                continue
+            sentCodes.add(fasta.accessCode)
+            if outputFormat == "fasta":
+                yield format_fasta_entry(fasta)
+            else:
+                yield json.dumps({"accessCode": fasta.accessCode,
+                                  "accession": fasta.accession,
+                                  "metaData": fasta.metaData,
+                                  "sequence": fasta.sequence}) + "\n"
+
+    if outputFormat == "fasta":
+        contentType = "text/plain;charset=UTF-8"
+    else:
+        contentType = "application/x-ndjson"
+    return Response(stream_with_context(generate()), content_type=contentType)
+
+def iter_bulk_fastas(entryCodes, listCodes):
+    """
+    Yields the fasta entries with the given access codes and then the members
+    of the given fasta lists, with one IN query per chunk of codes
+    """
+    for codes in _chunks(entryCodes):
+        for fasta in models.FastaEntry.query.filter(models.FastaEntry.accessCode.in_(codes)):
+            yield fasta
+    for codes in _chunks(listCodes):
+        memberQuery = (models.FastaEntry.query
+                       .join(models.list_to_fasta, models.list_to_fasta.c.fasta == models.FastaEntry.id)
+                       .join(models.FastaList, models.FastaList.id == models.list_to_fasta.c.fastaList)
+                       .filter(models.FastaList.accessCode.in_(codes)))
+        for fasta in memberQuery:
+            yield fasta
+
+def get_fasta_list_library(fastaListCode):
+    """
+    Returns the memory mapped, site indexed library of a fasta list, exporting
+    it to LIBRARY_CACHE_DIR on first use. The files are versioned by the
+    list's membership so edited lists get a fresh export, which replaces the
+    exports of earlier versions
+    """
+    fastaList = models.FastaList.query.filter_by(accessCode = fastaListCode).first()
+    if fastaList is None:
+        return None
+    membership = models.list_to_fasta
+    memberIds = [row[0] for row in db.session.execute(select([membership.c.fasta])
+                                                      .where(membership.c.fastaList == fastaList.id)
+                                                      .order_by(membership.c.fasta))]
+    version = sha256(",".join(str(memberId) for memberId in memberIds)).hexdigest()[0:16]
+    cacheDir = app.config.get("LIBRARY_CACHE_DIR")
+    basePath = path.join(cacheDir, "{}-{}".format(fastaList.accessCode, version))
+    records = lambda: ((fasta.accession, fasta.sequence) for fasta in iter_bulk_fastas([], [fastaList.accessCode]))
+    #access codes are urlsafe base64, so the version pattern cannot match another list's files
+    versions = lambda: [stalePath[:-len(".idx")] for stalePath in
+                        glob(path.join(cacheDir, fastaList.accessCode + "-" + "[0-9a-f]"*16 + ".idx"))]
+    return pee.open_mapped_library(basePath, records=records, supersededPaths=versions)
+
+def format_fasta_entry(fasta):
+    sequence = fasta.sequence
+    lines = [sequence[i:i+80] for i in range(0, len(sequence), 80)]
+    return ">" + fasta.accession + " " + fasta.metaData + "\n" + "\n".join(lines) + "\n"
+
+def _split_codes(codeString):
+    return [code.strip() for code in codeString.split(",") if code.strip()]
+
+def _chunks(items, size=500):
+    #keeps IN clauses below sqlite's bound parameter limit
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
 @app.route("/enzyme_analysis", methods = ['GET', 'POST'])
 def enzyme_analysis():
-    enzymeDict = pee.enzymeListNC
+    enzymeDict = pee.compile_enzyme_tables()
     enzymeChoices = [(enzyme, enzyme) for enzyme in enzymeDict]
     enzymeChoices.sort(key=lambda a: a[0])
+    #user enzymes are offered after the built-in ones
+    customRuleDict = {}
+    if g.userLoggedIn:
+        for rule in models.EnzymeRule.query.filter_by(user_id=g.user.id).order_by(models.EnzymeRule.name):
+            customRuleDict[pee.custom_enzyme_name(rule.name, rule.specificity)] = rule.specificity
+    enzymeChoices += [(enzyme, enzyme) for enzyme in sorted(customRuleDict)]
     form = forms.AnalyzeEnzymeActivity()
     form.selectedEnzymes.choices = enzymeChoices
     
     if form.validate_on_submit():
         #User input:
         processSuccessful = True
-        inputEnzymeList = form.selectedEnzymes.data
-        if len(inputEnzymeList) == 0:
+        inputEnzymeList = [enzyme for enzyme in form.selectedEnzymes.data if enzyme not in customRuleDict]
+        customRules = {enzyme: customRuleDict[enzyme] for enzyme in form.selectedEnzymes.data
+                       if enzyme in customRuleDict}
+        if len(inputEnzymeList) == 0 and len(customRules) == 0:
             inputEnzymeList = ["_No enzyme"]
 	peptideCsv = form.peptideCsv.data
         fastaString = form.fastaPlasteLibrary.data
         analysisType = form.analysisType.data
         
-        if form.fastaPlasteLibrary.data == "notfound":
+        library = get_fasta_list_library(fastaString)
+        if library is None:
             processSuccessful = False
             flash("Invalid protein library was selected")
         else:
-            fastaLibraryFile = StringIO(render_fasta_list(fastaString, returnFastaText=True))
-
+            #user enzymes are indexed for this analysis only, never in the shared library
+            library = pee.with_custom_rules(library, customRules)
             try:
-                peptideList = pee.import_peptides_and_preprocess(peptideCsv, fastaLibraryFile, inputEnzymeList)
+                peptideList = pee.import_peptides_and_preprocess(peptideCsv, library, inputEnzymeList,
+                                                                 customRules=customRules)
             except Exception, e:
                 flash("import not successful")
                 flash(e)
@@ -280,39 +398,167 @@ def enzyme_analysis():
                 results = pee.extract_data_from_processed_peptides(peptideList,
                                                                    inputEnzymeList,
                                                                    method=analysisType,
-                                                                   result="list")
+                                                                   library=library,
+                                                                   normalize=form.normalizeBySites.data,
+                                                                   customRules=customRules)
             except Exception, e:
                 flash("processing not successful")
                 flash(e)
                 processSuccessful = False
         
+            significanceData = None
+            if processSuccessful and form.resampleSignificance.data:
+                try:
+                    resampled = pee.resample_enzyme_responses(peptideList,
+                                                              inputEnzymeList,
+                                                              method=analysisType,
+                                                              iterations=app.config.get("RESAMPLING_ITERATIONS", 1000),
+                                                              processes=app.config.get("RESAMPLING_PROCESSES", 1),
+                                                              customRules=customRules,
+                                                              library=library,
+                                                              normalize=form.normalizeBySites.data)
+                    significanceData = pee.resampling_table(resampled)
+                except Exception, e:
+                    #the results are still shown without significance
+                    flash("resampling not successful")
+                    flash(e)
+
+            positionData = None
+            if processSuccessful and form.positionMatrices.data:
+                positionData = pee.residue_frequency_matrices(peptideList, library, method=analysisType)
+
             if processSuccessful:
-                headerList = results[0]
-                outputData = results[1:]
-                rawData = [sum(result[1:]) for result in outputData]
-                indexSp = len(inputEnzymeList)
+                #tables are served in pages by result_page instead of being rendered here
+                enzymes = pee.select_enzymes(inputEnzymeList, customRules).keys()
+                tables = {"results": resultstore.record_table(["group"], pee.result_fields(enzymes),
+                                                              (([group], values) for group, values
+                                                               in pee.iter_group_records(results, enzymes)))}
+                fields = tables["results"]["fields"]
+                rawData = [0]*len(fields)
+                for labelValues, values in tables["results"]["records"]:
+                    rawData = [total + value for total, value in zip(rawData, values)]
+                indexSp = len(enzymes)
                 
                 head = ["Response", "Summed data"]
                 
-                enzymeHeader = [result[0] for result in outputData[0:indexSp]]
-                enzymePlotData = [enzymeHeader, rawData[0:indexSp]]
-                enzymePlotData = [list(a) for a in zip(*enzymePlotData)]
+                enzymePlotData = [list(a) for a in zip(fields[0:indexSp], rawData[0:indexSp])]
                 enzymePlotData.sort(key=lambda a: -1*a[1])
                 enzymePlotData.insert(0, head)
                 enzymePlotData = json.dumps(enzymePlotData)
                 
-                orphanHeader = [result[0] for result in outputData[indexSp:]]
-                orphanPlotData = [orphanHeader, rawData[indexSp:]]
-                orphanPlotData = [list(a) for a in zip(*orphanPlotData)]
+                orphanPlotData = [list(a) for a in zip(fields[indexSp:], rawData[indexSp:])]
                 orphanPlotData.sort(key=lambda a: a[0])
                 orphanPlotData.insert(0, head)
                 orphanPlotData = json.dumps(orphanPlotData)
+
+                if significanceData is not None:
+                    tables["significance"] = resultstore.rows_table(significanceData, 2)
+                if positionData is not None:
+                    tables["positions"] = resultstore.rows_table(pee.frequency_matrix_rows(positionData), 3)
+                    #per position frequencies are the input sequence logo tools expect
+                    tables["position_frequencies"] = resultstore.rows_table(
+                        pee.frequency_matrix_rows(positionData, normalize=True), 3)
+                resultId = resultstore.store_result(tables, analysisType,
+                                                    userId=g.user.id if g.userLoggedIn else None)
                 
                 return render_template('peptidomics_enzyme_estimator_output.html', form=form,
-                                        headerList=headerList, outputData=outputData, enzymePlotData=enzymePlotData,
-                                        orphanPlotData=orphanPlotData)
+                                        resultId=resultId, enzymePlotData=enzymePlotData,
+                                        orphanPlotData=orphanPlotData, tableNames=tables.keys())
     
     return render_template('peptidomics_enzyme_estimator_input.html', form=form)
+
+
+@app.route("/enzyme_rules", methods = ['GET', 'POST'])
+@login_required
+def enzyme_rules():
+    form = forms.AddEnzymeRule()
+    if form.validate_on_submit():
+        name = form.name.data.strip()
+        if name in pee.compile_enzyme_tables():
+            form.name.errors.append("A built-in enzyme already has this name")
+        else:
+            rule = models.EnzymeRule(name = name,
+                                     specificity = form.specificity.data.strip(),
+                                     user_id = g.user.id,
+                                     added = datetime.utcnow())
+            db.session.add(rule)
+            db.session.commit()
+            flash("Enzyme {} has been added".format(name))
+            return redirect("/enzyme_rules")
+    rules = models.EnzymeRule.query.filter_by(user_id=g.user.id).order_by(models.EnzymeRule.name)
+    return render_template("enzyme_rules.html", form=form, rules=rules, deleteForm=forms.DeleteHidden())
+
+@app.route("/enzyme_rule/<int:rule_id>", methods = ['POST'])
+@login_required
+def delete_enzyme_rule(rule_id):
+    form = forms.DeleteHidden()
+    rule = models.EnzymeRule.query.filter_by(id = rule_id, user_id = g.user.id).first()
+    if rule is None:
+        flash("no enzyme matches this id")
+    elif form.validate_on_submit():
+        flash("enzyme {} deleted".format(rule.name))
+        db.session.delete(rule)
+        db.session.commit()
+    return redirect("/enzyme_rules")
+
+
+@app.route("/enzyme_analysis/<result_id>.json")
+def result_page(result_id):
+    """
+    Serves a slice of a stored analysis table, one row per record. Query
+    arguments: table (results, significance, positions or
+    position_frequencies), rowStart, rowCount, colStart, colCount, groups
+    (comma separated), sortRows (a column), sortColumns (a row's labels
+    joined by " / ") and order (asc or desc)
+    """
+    table = resultstore.load_result(result_id, request.args.get("table", "results"))
+    if table is None:
+        return Response(json.dumps({"error": "no result matches this id"}), status=404,
+                        content_type="application/json")
+    groups = request.args.get("groups", "")
+    try:
+        page = resultstore.page_result(table,
+                                       rowStart=request.args.get("rowStart", 0, type=int),
+                                       rowCount=request.args.get("rowCount", 50, type=int),
+                                       colStart=request.args.get("colStart", 0, type=int),
+                                       colCount=request.args.get("colCount", 20, type=int),
+                                       groups=[group.strip() for group in groups.split(",") if group.strip()],
+                                       sortRows=request.args.get("sortRows"),
+                                       sortColumns=request.args.get("sortColumns"),
+                                       descending=request.args.get("order", "asc") == "desc")
+    except KeyError, e:
+        return Response(json.dumps({"error": "unknown row or column {}".format(e)}), status=400,
+                        content_type="application/json")
+    page["resultId"] = result_id
+    return Response(json.dumps(page), content_type="application/json")
+
+@app.route("/enzyme_analysis/<result_id>.<any(csv, ndjson, npz):export_format>")
+def export_result(result_id, export_format):
+    """
+    Streams a stored analysis table (query argument table, default results)
+    with one line per record
+    """
+    tableName = request.args.get("table", "results")
+    table = resultstore.load_result(result_id, tableName)
+    if table is None:
+        return Response("no result matches this id", status=404, content_type="text/plain")
+    labels, fields = table["labels"], table["fields"]
+    fileName = "{}-{}.{}".format(result_id, tableName, export_format)
+    if export_format == "npz":
+        #zip archives need a seekable file, so the archive is spooled before sending
+        npzFile = TemporaryFile()
+        resultexport.write_npz(labels, fields, resultstore.iter_table_records(table), npzFile)
+        npzFile.seek(0)
+        #an anonymous temporary file has no name to derive an etag from
+        return send_file(npzFile, mimetype=resultexport.CONTENT_TYPES["npz"], as_attachment=True,
+                         attachment_filename=fileName, add_etags=False)
+    headers = {"Content-Disposition": "attachment; filename={}".format(fileName)}
+    if export_format == "csv":
+        lines = resultexport.iter_csv(labels, fields, resultstore.iter_table_records(table))
+    else:
+        lines = resultexport.iter_ndjson(labels, fields, resultstore.iter_table_records(table))
+    return Response(stream_with_context(lines), headers=headers,
+                    content_type=resultexport.CONTENT_TYPES[export_format])
     
 def add_fasta_entry(meta, seq, type="protein"): #returns {"success":bool, "error":str, "code":str}
     #meta data line reading and grab type/sequence
@@ -350,3 +596,19 @@ def add_fasta_entry(meta, seq, type="protein"): #returns {"success":bool, "error
         db.session.commit()
         return {"object":newFasta, "success":True, "error":'', "code":b64hash}
         #flash("new fasta added with access code = {}".format(b64hash))
+
+
+def warm_up(fastaListCodes=[]):
+    """
+    Prepares this process to serve analyses: loads the heavy dependencies
+    (including ioroutines and requests for /import_uniprot), compiles the
+    enzyme tables and caches the given fasta list libraries. The database
+    connections used here are closed again so that worker processes forked
+    afterwards open their own
+    """
+    pee.warmup()
+    import ioroutines
+    for fastaListCode in fastaListCodes:
+        get_fasta_list_library(fastaListCode)
+    db.session.remove()
+    db.engine.dispose()
@@ -0,0 +1,310 @@
+#!python27/bin/python
+"""
+Local load test of the hot routes. Builds the app through wsgi.py against a
+seeded temporary sqlite database, then for every worker count forks that
+many worker processes, each logged in with its own test client and sending
+a fixed mix of requests, and reports throughput, p50/p99 latency and error
+rate per route. No sockets or network are used:
+
+    python loadtest.py --workers 1,2,4 --requests 200 --entries 5000 --list-size 2000
+
+A worker process serving one client at a time models one worker of a
+preforking server (eg. gunicorn), so the rows for N workers show how the
+app and its sqlite database scale with N concurrent requests.
+"""
+
+from multiprocessing import Pool
+from cStringIO import StringIO
+from datetime import datetime
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import path, environ
+import argparse
+import random
+import json
+import sys
+import time
+
+LOADTEST_PASSWORD = "loadtest"
+AMINO_ACIDS = "AGPVLIMCFYWHKRQNEDST"
+
+#requests per worker are drawn from the routes in proportion to these weights
+ROUTE_WEIGHTS = [("/fastalist/<id>.fasta", 3),
+                 ("/fasta/<id>.fasta", 6),
+                 ("/my_activity", 3),
+                 ("/make_list", 2),
+                 ("/enzyme_analysis", 1)]
+
+#set in the parent before workers fork
+_application = None
+_fixture = None
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Load test the fpaste hot routes locally")
+    parser.add_argument("-w", "--workers", default="1,2,4",
+                        help="comma separated worker process counts to run (default: 1,2,4)")
+    parser.add_argument("-n", "--requests", type=int, default=200,
+                        help="requests sent by every worker (default: 200)")
+    parser.add_argument("--users", type=int, default=4, help="seeded users")
+    parser.add_argument("--entries", type=int, default=5000, help="seeded fasta entries")
+    parser.add_argument("--lists", type=int, default=4, help="seeded large fasta lists")
+    parser.add_argument("--list-size", dest="listSize", type=int, default=2000,
+                        help="fasta entries in every large list")
+    parser.add_argument("--edit-size", dest="editSize", type=int, default=50,
+                        help="fasta entries added and removed by one /make_list request")
+    parser.add_argument("--peptides", type=int, default=2000,
+                        help="peptide rows in the /enzyme_analysis upload")
+    parser.add_argument("-e", "--enzyme", dest="enzymes", action="append", default=[],
+                        help="enzyme selected in /enzyme_analysis (default: Trypsin and Elastase)")
+    parser.add_argument("--routes", default=",".join(route for route, weight in ROUTE_WEIGHTS),
+                        help="comma separated subset of the routes to drive")
+    parser.add_argument("--cold", action="store_true",
+                        help="do not cache the list libraries before workers fork")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--json", dest="jsonPath", help="also write the report rows to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database directory")
+    return parser.parse_args(argv)
+
+
+def _random_sequence(rng, minLength=100, maxLength=600):
+    return "".join(rng.choice(AMINO_ACIDS) for i in range(rng.randint(minLength, maxLength)))
+
+def _access_code(prefix, i, length):
+    return prefix + str(i).zfill(length - len(prefix))
+
+
+def seed_database(args, maxWorkers, rng):
+    """
+    Fills the empty database with users, fasta entries, large fasta lists
+    for downloads and analysis and one small list per worker for /make_list.
+    Returns the fixture the workers draw their requests from
+    """
+    from fpaste import db, models
+    db.create_all()
+    users = []
+    for i in range(args.users):
+        user = models.User(nickname="loaduser{}".format(i), email="loaduser{}@localhost".format(i))
+        user.new_password(LOADTEST_PASSWORD)
+        db.session.add(user)
+        users.append(user)
+    db.session.commit()
+    userIds = [user.id for user in users]
+
+    now = datetime.utcnow()
+    entryRows, sequences = [], {}
+    for i in range(args.entries):
+        accession = "LT{:06d}".format(i)
+        sequences[accession] = _random_sequence(rng)
+        entryRows.append({"accessCode": _access_code("loadfasta", i, 15),
+                          "accession": accession,
+                          "metaData": "load test protein {}".format(i),
+                          "sequence": sequences[accession],
+                          "added": now,
+                          "user_id": userIds[i % len(userIds)]})
+    db.session.execute(models.FastaEntry.__table__.insert(), entryRows)
+    db.session.commit()
+    entries = [(row[0], row[1], row[2]) for row in
+               db.session.query(models.FastaEntry.id, models.FastaEntry.accessCode, models.FastaEntry.accession)]
+
+    def add_list(code, userId, members):
+        fastaList = models.FastaList(accessCode=code, user_id=userId, added=now)
+        db.session.add(fastaList)
+        db.session.flush()
+        if len(members) > 0:
+            db.session.execute(models.list_to_fasta.insert(),
+                               [{"fasta": member[0], "fastaList": fastaList.id} for member in members])
+        return code
+
+    listSize = min(args.listSize, len(entries))
+    largeLists, largeListMembers = [], {}
+    for i in range(args.lists):
+        members = rng.sample(entries, listSize)
+        code = add_list(_access_code("loadlist", i, 20), userIds[i % len(userIds)], members)
+        largeLists.append(code)
+        largeListMembers[code] = [member[2] for member in members]
+    editLists = []
+    for i in range(maxWorkers):
+        editLists.append(add_list(_access_code("loadedit", i, 20), userIds[i % len(userIds)],
+                                  rng.sample(entries, min(args.editSize, len(entries)))))
+    db.session.commit()
+
+    #peptide uploads are cut from the proteins of the analyzed list
+    analysisList = largeLists[0]
+    csvLines = ["sequence,intensity,protein_id,sample_id,rt"]
+    for i in range(args.peptides):
+        accession = rng.choice(largeListMembers[analysisList])
+        sequence = sequences[accession]
+        length = rng.randint(8, 25)
+        start = rng.randint(0, len(sequence) - length)
+        csvLines.append("{},{:.3f},{},sample{},{:.2f}".format(sequence[start:start+length],
+                                                            rng.uniform(100, 10000), accession,
+                                                            i % 4, rng.uniform(1, 60)))
+    return {"users": ["loaduser{}".format(i) for i in range(args.users)],
+            "entryCodes": [entry[1] for entry in entries],
+            "largeLists": largeLists,
+            "editLists": editLists,
+            "analysisList": analysisList,
+            "peptideCsv": "\n".join(csvLines) + "\n",
+            "enzymes": args.enzymes or ["Trypsin", "Elastase"],
+            "editSize": args.editSize}
+
+
+def _fasta_list(client, rng, fixture, workerIndex):
+    response = client.get("/fastalist/{}.fasta".format(rng.choice(fixture["largeLists"])))
+    return response, response.data.startswith(">")
+
+def _fasta(client, rng, fixture, workerIndex):
+    response = client.get("/fasta/{}.fasta".format(rng.choice(fixture["entryCodes"])))
+    return response, response.data.startswith(">")
+
+def _my_activity(client, rng, fixture, workerIndex):
+    response = client.get("/my_activity")
+    return response, True
+
+def _make_list(client, rng, fixture, workerIndex):
+    codes = rng.sample(fixture["entryCodes"], 2*fixture["editSize"])
+    response = client.post("/make_list", data={"fastaList": fixture["editLists"][workerIndex],
+                                               "fastaAdd": ",".join(codes[:fixture["editSize"]]),
+                                               "fastaSubtract": ",".join(codes[fixture["editSize"]:])})
+    return response, "has been modified" in response.data
+
+def _enzyme_analysis(client, rng, fixture, workerIndex):
+    response = client.post("/enzyme_analysis",
+                           data={"fastaPlasteLibrary": fixture["analysisList"],
+                                 "selectedEnzymes": fixture["enzymes"],
+                                 "analysisType": "sampleId",
+                                 "peptideCsv": (StringIO(fixture["peptideCsv"]), "peptides.csv")})
+    return response, "Result id:" in response.data
+
+ROUTE_REQUESTS = {"/fastalist/<id>.fasta": _fasta_list,
+                  "/fasta/<id>.fasta": _fasta,
+                  "/my_activity": _my_activity,
+                  "/make_list": _make_list,
+                  "/enzyme_analysis": _enzyme_analysis}
+
+
+def _run_worker(task):
+    """
+    Logs in and sends the worker's requests, returns its start and end time
+    and a (route, seconds, ok) sample per request
+    """
+    workerIndex, schedule, seed = task
+    rng = random.Random(seed)
+    client = _application.test_client()
+    userName = _fixture["users"][workerIndex % len(_fixture["users"])]
+    client.post("/login", data={"username": userName, "userkey": LOADTEST_PASSWORD})
+    samples = []
+    startTime = time.time()
+    for route in schedule:
+        requestStart = time.time()
+        try:
+            response, expected = ROUTE_REQUESTS[route](client, rng, _fixture, workerIndex)
+            ok = response.status_code == 200 and expected
+        except Exception:
+            ok = False
+        samples.append((route, time.time() - requestStart, ok))
+    return (startTime, time.time(), samples)
+
+
+def _percentile(sortedValues, fraction):
+    return sortedValues[int(round(fraction * (len(sortedValues) - 1)))]
+
+def summarize(workerCount, workerResults):
+    """
+    Returns one report row per route and one for all routes of a run
+    """
+    wallTime = max(result[1] for result in workerResults) - min(result[0] for result in workerResults)
+    byRoute = {}
+    for startTime, endTime, samples in workerResults:
+        for route, seconds, ok in samples:
+            byRoute.setdefault(route, []).append((seconds, ok))
+    byRoute["all"] = [sample for route in byRoute.keys() for sample in byRoute[route]]
+    rows = []
+    for route in [route for route, weight in ROUTE_WEIGHTS if route in byRoute] + ["all"]:
+        latencies = sorted(seconds for seconds, ok in byRoute[route])
+        errors = sum(1 for seconds, ok in byRoute[route] if not ok)
+        rows.append({"workers": workerCount,
+                     "route": route,
+                     "requests": len(latencies),
+                     "errors": errors,
+                     "errorRate": errors / float(len(latencies)),
+                     "throughput": len(latencies) / wallTime,
+                     "p50": _percentile(latencies, 0.50),
+                     "p99": _percentile(latencies, 0.99)})
+    return rows
+
+def print_rows(rows):
+    print "{:>7}  {:<22}{:>9}{:>8}{:>8}{:>10}{:>10}{:>10}".format(
+        "workers", "route", "requests", "errors", "err %", "req/s", "p50 ms", "p99 ms")
+    for row in rows:
+        print "{:>7}  {:<22}{:>9}{:>8}{:>8.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            row["workers"], row["route"], row["requests"], row["errors"], 100*row["errorRate"],
+            row["throughput"], 1000*row["p50"], 1000*row["p99"])
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    global _application, _fixture
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    workerCounts = [int(count) for count in args.workers.split(",") if count.strip()]
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknownRoutes = [route for route in routes if route not in ROUTE_REQUESTS]
+    if len(unknownRoutes) > 0:
+        sys.stderr.write("unknown routes: {}\n".format(", ".join(unknownRoutes)))
+        return 2
+    if len(workerCounts) == 0 or min(workerCounts) < 1:
+        sys.stderr.write("worker counts have to be positive\n")
+        return 2
+
+    tempDir = mkdtemp(prefix="fpaste-loadtest-")
+    environ["FPASTE_DATABASE_URI"] = "sqlite:///" + path.join(tempDir, "loadtest.db")
+    environ["FPASTE_LIBRARY_CACHE_DIR"] = path.join(tempDir, "library_cache")
+    try:
+        import wsgi
+        from fpaste import db
+        from fpaste.views import warm_up
+        _application = wsgi.application
+        _application.config["CSRF_ENABLED"] = False
+        _application.config["WTF_CSRF_ENABLED"] = False
+
+        rng = random.Random(args.seed)
+        seedStart = time.time()
+        _fixture = seed_database(args, max(workerCounts), rng)
+        sys.stderr.write("seeded {} users, {} fasta entries, {} lists of {} in {:.2f}s\n".format(
+            args.users, args.entries, args.lists, args.listSize, time.time() - seedStart))
+        #workers must not share the parent's sqlite connections
+        if args.cold:
+            db.session.remove()
+            db.engine.dispose()
+        else:
+            warm_up(_fixture["largeLists"])
+
+        weights = dict(ROUTE_WEIGHTS)
+        routeMix = [route for route in routes for i in range(weights[route])]
+        allRows = []
+        for workerCount in workerCounts:
+            tasks = [(workerIndex, [rng.choice(routeMix) for i in range(args.requests)], rng.random())
+                     for workerIndex in range(workerCount)]
+            pool = Pool(workerCount)
+            try:
+                workerResults = pool.map(_run_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+            rows = summarize(workerCount, workerResults)
+            print_rows(rows)
+            allRows += rows
+        if args.jsonPath:
+            with open(args.jsonPath, "w") as jsonFile:
+                json.dump(allRows, jsonFile, indent=1)
+    finally:
+        if args.keep:
+            sys.stderr.write("database kept in {}\n".format(tempDir))
+        else:
+            rmtree(tempDir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
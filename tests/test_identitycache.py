@@ -0,0 +1,80 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+#the app reads its database location when it is imported
+_tempDir = tempfile.mkdtemp()
+os.environ["FPASTE_DATABASE_URI"] = "sqlite:///" + os.path.join(_tempDir, "test.db")
+os.environ["FPASTE_LIBRARY_CACHE_DIR"] = os.path.join(_tempDir, "library_cache")
+
+from fpaste import app, db, models
+from fpaste.identitycache import identityCache
+
+from sqlalchemy import event
+
+USER_QUERY = re.compile(r'\bFROM "?user"?(\s|$)')
+
+
+class UserIdentityCacheTest(unittest.TestCase):
+    """
+    Counts the user row queries of logged in requests while the identity
+    cache misses, hits and is invalidated by an update of the user row
+    """
+
+    def setUp(self):
+        app.config["TESTING"] = True
+        app.config["CSRF_ENABLED"] = False
+        app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        user = models.User(nickname="cacheuser", email="cacheuser@localhost")
+        user.new_password("cachekey")
+        db.session.add(user)
+        db.session.commit()
+        self.userId = user.id
+        db.session.remove()
+        self.client = app.test_client()
+        response = self.client.post("/login", data={"username": "cacheuser", "userkey": "cachekey"})
+        self.assertEqual(response.status_code, 302)
+        self.statements = []
+        event.listen(db.engine, "before_cursor_execute", self._record_statement)
+
+    def tearDown(self):
+        event.remove(db.engine, "before_cursor_execute", self._record_statement)
+        identityCache.invalidate()
+        db.session.remove()
+        db.drop_all()
+
+    def _record_statement(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def _user_queries(self, url="/my_activity"):
+        del self.statements[:]
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len([statement for statement in self.statements if USER_QUERY.search(statement)])
+
+    def test_miss_then_hit(self):
+        identityCache.invalidate()
+        self.assertEqual(self._user_queries(), 1)
+        self.assertEqual(self._user_queries(), 0)
+
+    def test_update_invalidates(self):
+        identityCache.invalidate()
+        self._user_queries()
+        self.assertEqual(self._user_queries(), 0)
+        user = models.User.query.get(self.userId)
+        user.email = "renamed@localhost"
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(self._user_queries(), 1)
+        self.assertEqual(self._user_queries(), 0)
+
+
+def tearDownModule():
+    shutil.rmtree(_tempDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fpaste"))
+import resultexport
+
+
+class WriteNpzTest(unittest.TestCase):
+    """
+    Writes archives with the labels of the command line tool, whose "file"
+    label shares its name with an argument of numpy's savez
+    """
+
+    def test_file_label_round_trip(self):
+        labels = ["file", "group"]
+        fields = ["Trypsin", "A-c-side"]
+        records = [(["run0.csv", "sample0"], [1.5, 0]),
+                   ([u"run1.csv", u"sample1"], [2, 3.25])]
+        with tempfile.TemporaryFile() as npzFile:
+            resultexport.write_npz(labels, fields, iter(records), npzFile)
+            npzFile.seek(0)
+            archive = np.load(npzFile)
+            self.assertEqual(list(archive["labels"]), labels)
+            self.assertEqual(list(archive["fields"]), fields)
+            self.assertEqual(list(archive["label_file"]), ["run0.csv", "run1.csv"])
+            self.assertEqual(list(archive["label_group"]), ["sample0", "sample1"])
+            self.assertEqual(archive["values"].tolist(), [[1.5, 0], [2, 3.25]])
+
+    def test_empty_table(self):
+        with tempfile.TemporaryFile() as npzFile:
+            resultexport.write_npz(["file", "group"], ["Trypsin"], [], npzFile)
+            npzFile.seek(0)
+            archive = np.load(npzFile)
+            self.assertEqual(archive["values"].shape, (0, 1))
+            self.assertEqual(len(archive["label_file"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import unittest
+
+#the app reads its database location when it is imported
+os.environ.setdefault("FPASTE_DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+
+from fpaste import resultstore
+
+
+class PageResultTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = resultstore.record_table(["group"], ["Trypsin", "Elastase", "A-c-side"],
+                                              (([group], [g, 10*g, 100*g]) for g, group in
+                                               enumerate(["sample0", "sample1", "sample2"])))
+
+    def test_negative_offsets_start_at_zero(self):
+        page = resultstore.page_result(self.table, rowStart=-5, rowCount=2, colStart=-1, colCount=2)
+        self.assertEqual(page["rowStart"], 0)
+        self.assertEqual(page["colStart"], 0)
+        self.assertEqual(page["columns"], ["Trypsin", "Elastase"])
+        self.assertEqual(page["rows"], [["sample0", 0, 0], ["sample1", 1, 10]])
+
+    def test_page_past_the_end_is_empty(self):
+        page = resultstore.page_result(self.table, rowStart=3, rowCount=2)
+        self.assertEqual(page["totalRows"], 3)
+        self.assertEqual(page["rows"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
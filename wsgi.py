@@ -1,8 +1,34 @@
-activate_this = '/home/wwwadmin/fastadb/python27/bin/activate_this.py'
-execfile(activate_this, dict(__file__=activate_this))
 import sys
+import time
+startTime = time.time()
+
+from os import path, environ
+#FPASTE_PROFILE_STARTUP=1 prints where import and warmup spend their time
+profiler = None
+if environ.get("FPASTE_PROFILE_STARTUP"):
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+activate_this = '/home/wwwadmin/fastadb/python27/bin/activate_this.py'
+#outside the deployment (eg. loadtest.py) the current interpreter is used
+if path.exists(activate_this):
+    execfile(activate_this, dict(__file__=activate_this))
 sys.path.insert(0, '/home/wwwadmin/fastadb')
 from fpaste import app as application
+importTime = time.time()
+
+#build the enzyme tables and hot library caches once, before a preforking
+#server (e.g. gunicorn --preload) forks, so workers share them copy-on-write
+from fpaste.views import warm_up
+warm_up(application.config.get("WARMUP_FASTA_LISTS", []))
+warmupTime = time.time()
+if profiler is not None:
+    import pstats
+    profiler.disable()
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(r"<module>", 30)
+sys.stderr.write("fpaste startup: import {:.3f}s, warmup {:.3f}s\n".format(importTime - startTime,
+                                                                         warmupTime - importTime))
 
 if __name__ == '__main__':
     application.run()